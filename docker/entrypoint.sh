@@ -38,6 +38,16 @@ setup_rabbitmq_bindings() {
     return 0
 }
 
+# This function keeps a signal flushing process running, restarting it
+# if it exits. The task workers do not send their signals themselves
+# when APP_SIGNALBUS_AUTOFLUSH is "False".
+run_signal_flusher() {
+    while true; do
+        flask swpt_payments flush_signals --listen || true
+        sleep 5
+    done
+}
+
 # This function is intended to perform additional one-time
 # initializations. Make sure that it is idempotent.
 # (https://en.wikipedia.org/wiki/Idempotence)
@@ -55,8 +65,9 @@ case $1 in
         perform_db_upgrade
         setup_rabbitmq_bindings
         perform_initializations
-        flask signalbus flush -w 0
-        exec dramatiq --processes ${DRAMATIQ_PROCESSES-4} --threads ${DRAMATIQ_THREADS-8} "$@"
+        run_signal_flusher &
+        eval $(python -m swpt_payments.sizing)
+        exec dramatiq --processes $DRAMATIQ_PROCESSES --threads $DRAMATIQ_THREADS "$@"
         ;;
     test)
         perform_db_upgrade
@@ -76,11 +87,13 @@ case $1 in
         ;;
     tasks)
         shift
-        exec dramatiq --processes ${DRAMATIQ_PROCESSES-4} --threads ${DRAMATIQ_THREADS-8} "$@"
+        eval $(python -m swpt_payments.sizing)
+        exec dramatiq --processes $DRAMATIQ_PROCESSES --threads $DRAMATIQ_THREADS "$@"
         ;;
     tasks-gevent)
         shift
-        exec dramatiq-gevent --processes ${DRAMATIQ_PROCESSES-4} --threads ${DRAMATIQ_GREENLETS-8} "$@"
+        eval $(python -m swpt_payments.sizing --gevent)
+        exec dramatiq-gevent --processes $DRAMATIQ_PROCESSES --threads $DRAMATIQ_GREENLETS "$@"
         ;;
     *)
         exec "$@"
@@ -0,0 +1,48 @@
+"""empty message
+
+Revision ID: 4d8a2f61c0b3
+Revises: 7c4e19d2a850
+Create Date: 2026-10-18 16:21:07.448120
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4d8a2f61c0b3'
+down_revision = '7c4e19d2a850'
+branch_labels = None
+depends_on = None
+
+SIGNAL_TABLES = [
+    'created_formal_offer_signal',
+    'canceled_formal_offer_signal',
+    'failed_reciprocal_payment_signal',
+    'successful_payment_signal',
+    'failed_payment_signal',
+    'prepare_transfer_signal',
+    'finalize_prepared_transfer_signal',
+]
+
+
+def upgrade():
+    op.execute("""
+        CREATE FUNCTION notify_signal_inserted() RETURNS trigger AS $$
+        BEGIN
+          PERFORM pg_notify('swpt_payments_signals', TG_TABLE_NAME);
+          RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    for table_name in SIGNAL_TABLES:
+        op.execute(f"""
+            CREATE TRIGGER {table_name}_notify AFTER INSERT ON {table_name}
+            FOR EACH STATEMENT EXECUTE PROCEDURE notify_signal_inserted()
+        """)
+
+
+def downgrade():
+    for table_name in SIGNAL_TABLES:
+        op.execute(f'DROP TRIGGER {table_name}_notify ON {table_name}')
+    op.execute('DROP FUNCTION notify_signal_inserted()')
@@ -34,11 +34,12 @@ class Configuration(metaclass=MetaFlaskEnv):
 
 def create_app(config_dict={}):
     from flask import Flask
-    from .extensions import db, migrate, broker
+    from .extensions import db, migrate, broker, make_psycopg2_green
     from .routes import web_api
     from .cli import swpt_payments
     from . import models  # noqa
 
+    make_psycopg2_green()
     app = Flask(__name__)
     app.config.from_object(Configuration)
     app.config.from_mapping(config_dict)
@@ -1,10 +1,24 @@
 from typing import Optional, List
 from base64 import urlsafe_b64decode
+from datetime import datetime
 import iso8601
 from .extensions import broker, APP_QUEUE_NAME
 from . import procedures
 
 
+def _parse_timestamp(s: str) -> datetime:
+    # `datetime.fromisoformat` is much faster than `iso8601.parse_date`,
+    # but it does not understand the "Z" suffix, nor many of the other
+    # formats allowed by ISO 8601.
+    try:
+        ts = datetime.fromisoformat(s[:-1] + '+00:00' if s.endswith('Z') else s)
+    except ValueError:
+        ts = None
+    if ts is None or ts.tzinfo is None:
+        ts = iso8601.parse_date(s)
+    return ts
+
+
 @broker.actor(queue_name=APP_QUEUE_NAME)
 def create_formal_offer(
         payee_creditor_id: int,
@@ -24,7 +38,8 @@ def create_formal_offer(
     in `debtor_amounts`). The offer will be valid until
     `valid_until_ts`. `offer_announcement_id` is a number generated by
     the payee (who creates the offer), and must be different for each
-    offer announced by a given payee.
+    offer announced by a given payee. Offers that have expired will
+    eventually be canceled automatically.
 
     If `reciprocal_payment_debtor_id` is not `None`, an automated
     reciprocal transfer (for the `reciprocal_payment_amount`, via this
@@ -32,6 +47,12 @@ def create_formal_offer(
     paid. This allows formal offers to be used as a form of currency
     swapping mechanism.
 
+    The size of the JSON-serialized `description` must not exceed
+    `APP_MAX_OFFER_DESCRIPTION_BYTES` (10000 bytes by default). If it
+    does, the offer will be canceled immediately: a
+    `CreatedFromalOfferSignal` will be sent, followed by a
+    `CanceledFormalOfferSignal` for the same offer.
+
     Before sending a message to this actor, the sender must create a
     Formal Offer (FO) database record, with a primary key of
     `(payee_creditor_id, offer_announcement_id)`, and status
@@ -97,7 +118,7 @@ def create_formal_offer(
         offer_announcement_id,
         debtor_ids,
         debtor_amounts,
-        iso8601.parse_date(valid_until_ts),
+        _parse_timestamp(valid_until_ts),
         description,
         reciprocal_payment_debtor_id,
         reciprocal_payment_amount,
@@ -144,7 +165,8 @@ def make_payment_order(
 
     If the payment is successfull, a `SuccessfulPaymentSignal` will be
     sent. If the payment is not successful, a `FailedPaymentSignal`
-    will be sent.
+    will be sent. Payment orders which JSON-serialized `payer_note`
+    exceeds `APP_MAX_PAYER_NOTE_BYTES` (1000 bytes by default) fail.
 
     """
 
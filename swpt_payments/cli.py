@@ -1,7 +1,15 @@
+import time
+import queue
+import select
+import threading
 import click
 from os import environ
+from concurrent.futures import Future
 from datetime import datetime, timezone, timedelta
+from flask import current_app
 from flask.cli import with_appcontext
+from .extensions import db, close_publishing_connection
+from .models import SIGNAL_NOTIFICATION_CHANNEL
 from . import procedures
 
 
@@ -13,38 +21,85 @@ def swpt_payments():
 @swpt_payments.command()
 @with_appcontext
 @click.argument('queue_name')
-def subscribe(queue_name):  # pragma: no cover
+def subscribe(queue_name):
     """Subscribe a queue for the observed events and messages.
 
     QUEUE_NAME specifies the name of the queue.
 
+    When the value of the environment variable APP_QUEUE_SHARDS is
+    bigger than one, messages are sharded among that many queues,
+    named "QUEUE_NAME.0", "QUEUE_NAME.1", and so on. Each shard queue
+    is subscribed for the routing keys that have the shard number
+    appended (for example, "events.on_prepared_payment_transfer_signal.1").
+    The first shard queue is subscribed for the non-sharded routing
+    keys as well. Publishers must pick the shard of a message with
+    the `swpt_payments.extensions.get_shard_queue_name()` function
+    (see README).
+
+    When the environment variable APP_USE_LOAD_BALANCING_EXCHANGE is
+    set, a consistent-hash exchange named QUEUE_NAME is subscribed
+    instead, and the messages are distributed by their routing keys
+    among the queues "QUEUE_NAME.p0", "QUEUE_NAME.p1", and so on. The
+    number of queues and their relative weights are given by the
+    environment variable APP_LOAD_BALANCING_QUEUE_WEIGHTS (a
+    comma-separated list of integers, "1" by default). Note that
+    messages are distributed evenly only if the publishers shard the
+    routing keys (see APP_QUEUE_SHARDS).
+
     """
 
-    from .extensions import broker, MAIN_EXCHANGE_NAME
+    from .extensions import broker, get_shard_queue_names, get_partition_queue_names, MAIN_EXCHANGE_NAME, \
+        APP_QUEUE_SHARDS, APP_USE_LOAD_BALANCING_EXCHANGE, APP_LOAD_BALANCING_QUEUE_WEIGHTS
     from . import actors  # noqa
 
     channel = broker.channel
     channel.exchange_declare(MAIN_EXCHANGE_NAME)
     click.echo(f'Declared "{MAIN_EXCHANGE_NAME}" direct exchange.')
 
-    if environ.get('APP_USE_LOAD_BALANCING_EXCHANGE', '') not in ['', 'False']:
+    if APP_USE_LOAD_BALANCING_EXCHANGE:  # pragma: no cover
+        channel.exchange_declare(queue_name, exchange_type='x-consistent-hash', durable=True)
+        click.echo(f'Declared "{queue_name}" consistent-hash exchange.')
+        partition_queue_names = get_partition_queue_names(queue_name)
+        for partition_queue_name, weight in zip(partition_queue_names, APP_LOAD_BALANCING_QUEUE_WEIGHTS):
+            broker.declare_queue(partition_queue_name)
+            channel.queue_bind(partition_queue_name, queue_name, str(weight))
+            click.echo(f'Bound "{partition_queue_name}" to "{queue_name}" with weight {weight}.')
         bind = channel.exchange_bind
         unbind = channel.exchange_unbind
+        destinations = [queue_name] * APP_QUEUE_SHARDS
     else:
         bind = channel.queue_bind
         unbind = channel.queue_unbind
-    bind(queue_name, MAIN_EXCHANGE_NAME, queue_name)
-    click.echo(f'Subscribed "{queue_name}" to "{MAIN_EXCHANGE_NAME}.{queue_name}".')
+        destinations = get_shard_queue_names(queue_name, APP_QUEUE_SHARDS)
+        for destination in destinations:
+            broker.declare_queue(destination)
+            click.echo(f'Declared "{destination}" queue.')
+
+    declared_actors = [broker.get_actor(actor_name) for actor_name in broker.get_declared_actors()]
+    for i, destination in enumerate(destinations):
+        if len(destinations) == 1:
+            suffixes = ['']
+        elif i == 0:
+            suffixes = ['', '.0']
+        else:
+            suffixes = [f'.{i}']
+        for routing_key in [queue_name + s for s in suffixes]:
+            bind(destination, MAIN_EXCHANGE_NAME, routing_key)
+            click.echo(f'Subscribed "{destination}" to "{MAIN_EXCHANGE_NAME}.{routing_key}".')
+        for actor in declared_actors:
+            if 'event_subscription' in actor.options:
+                for routing_key in [f'events.{actor.actor_name}{s}' for s in suffixes]:
+                    if actor.options['event_subscription']:
+                        bind(destination, MAIN_EXCHANGE_NAME, routing_key)
+                        click.echo(f'Subscribed "{destination}" to "{MAIN_EXCHANGE_NAME}.{routing_key}".')
+                    else:
+                        unbind(destination, MAIN_EXCHANGE_NAME, routing_key)
+                        click.echo(f'Unsubscribed "{destination}" from "{MAIN_EXCHANGE_NAME}.{routing_key}".')
 
-    for actor in [broker.get_actor(actor_name) for actor_name in broker.get_declared_actors()]:
-        if 'event_subscription' in actor.options:
-            routing_key = f'events.{actor.actor_name}'
-            if actor.options['event_subscription']:
-                bind(queue_name, MAIN_EXCHANGE_NAME, routing_key)
-                click.echo(f'Subscribed "{queue_name}" to "{MAIN_EXCHANGE_NAME}.{routing_key}".')
-            else:
-                unbind(queue_name, MAIN_EXCHANGE_NAME, routing_key)
-                click.echo(f'Unsubscribed "{queue_name}" from "{MAIN_EXCHANGE_NAME}.{routing_key}".')
+    if APP_USE_LOAD_BALANCING_EXCHANGE:  # pragma: no cover
+        total_weight = sum(APP_LOAD_BALANCING_QUEUE_WEIGHTS)
+        for partition_queue_name, weight in zip(partition_queue_names, APP_LOAD_BALANCING_QUEUE_WEIGHTS):
+            click.echo(f'"{partition_queue_name}" receives about {100 * weight / total_weight:.0f}% of the messages.')
 
 
 @swpt_payments.command('flush_payment_orders')
@@ -97,3 +152,316 @@ def flush_payment_proofs(days):
         click.echo(f'1 payment proof has been deleted.')
     elif n > 1:  # pragma: nocover
         click.echo(f'{n} payment proofs have been deleted.')
+
+
+@swpt_payments.command('cancel_expired_offers')
+@with_appcontext
+@click.option('-d', '--days', type=float, help='The number of days.')
+@click.option('-b', '--batch-size', type=int, help='The maximum number of offers canceled in one transaction.')
+def cancel_expired_offers(days, batch_size):
+    """Cancel offers that have expired more than a given number of days ago.
+
+    If the number of days is not specified, the value of the
+    environment variable APP_CANCEL_EXPIRED_OFFERS_DAYS is taken. If
+    it is not set, the default number of days is 1.
+
+    The offers are canceled in batches, each batch in a separate
+    transaction. If the batch size is not specified, the value of the
+    environment variable APP_CANCEL_EXPIRED_OFFERS_BATCH_SIZE is
+    taken. If it is not set, the default batch size is 1000. Offers
+    that are locked by other transactions are skipped.
+
+    """
+
+    days = days or float(environ.get('APP_CANCEL_EXPIRED_OFFERS_DAYS', '1'))
+    batch_size = batch_size or int(environ.get('APP_CANCEL_EXPIRED_OFFERS_BATCH_SIZE', '1000'))
+    cutoff_ts = datetime.now(tz=timezone.utc) - timedelta(days=days)
+    n = 0
+    while True:
+        count = procedures.cancel_expired_formal_offers(cutoff_ts, batch_size)
+        n += count
+        if count < batch_size:
+            break
+    if n == 1:
+        click.echo(f'1 expired offer has been canceled.')
+    elif n > 1:  # pragma: nocover
+        click.echo(f'{n} expired offers have been canceled.')
+
+
+@swpt_payments.command('process_stale_payment_orders')
+@with_appcontext
+@click.option('-r', '--resend-hours', type=float, help='The number of hours before re-sending.')
+@click.option('-a', '--abort-hours', type=float, help='The number of hours before aborting.')
+@click.option('-b', '--batch-size', type=int, help='The maximum number of payment orders processed in one transaction.')
+@click.option('-t', '--time-budget', type=float, help='The maximum number of seconds to work.')
+def process_stale_payment_orders(resend_hours, abort_hours, batch_size, time_budget):
+    """Re-send or abort payment orders that have not been finalized for too long.
+
+    Unfinalized payment orders older than a given number of hours get
+    their prepare transfer signal re-sent. If the number of hours is
+    not specified, the value of the environment variable
+    APP_STALE_PAYMENT_ORDERS_RESEND_HOURS is taken. If it is not set,
+    the default number of hours is 1.
+
+    Unfinalized payment orders older than a given number of hours get
+    aborted. If the number of hours is not specified, the value of the
+    environment variable APP_STALE_PAYMENT_ORDERS_ABORT_HOURS is
+    taken. If it is not set, the default number of hours is 24.
+
+    The payment orders are processed in batches, each batch in a
+    separate transaction, until there are no more stale payment
+    orders, or the time budget has been exhausted. If not specified,
+    the values of the environment variables
+    APP_STALE_PAYMENT_ORDERS_BATCH_SIZE (default 1000), and
+    APP_STALE_PAYMENT_ORDERS_TIME_BUDGET (default 60 seconds) are
+    taken. Payment orders that are locked by other transactions are
+    skipped.
+
+    """
+
+    resend_hours = resend_hours or float(environ.get('APP_STALE_PAYMENT_ORDERS_RESEND_HOURS', '1'))
+    abort_hours = abort_hours or float(environ.get('APP_STALE_PAYMENT_ORDERS_ABORT_HOURS', '24'))
+    batch_size = batch_size or int(environ.get('APP_STALE_PAYMENT_ORDERS_BATCH_SIZE', '1000'))
+    time_budget = time_budget or float(environ.get('APP_STALE_PAYMENT_ORDERS_TIME_BUDGET', '60'))
+    deadline = time.monotonic() + time_budget
+    current_ts = datetime.now(tz=timezone.utc)
+    resend_cutoff_ts = current_ts - timedelta(hours=resend_hours)
+    abort_cutoff_ts = current_ts - timedelta(hours=abort_hours)
+
+    n = 0
+    while time.monotonic() < deadline:
+        count = procedures.abort_stale_payment_orders(abort_cutoff_ts, batch_size)
+        n += count
+        if count < batch_size:
+            break
+    if n == 1:
+        click.echo(f'1 stale payment order has been aborted.')
+    elif n > 1:  # pragma: nocover
+        click.echo(f'{n} stale payment orders have been aborted.')
+
+    prev = None
+    while time.monotonic() < deadline:
+        prev = procedures.resend_stale_prepare_transfer_signals(
+            abort_cutoff_ts,
+            resend_cutoff_ts,
+            batch_size,
+            prev,
+        )
+        if prev is None:
+            break
+
+
+@swpt_payments.command('flush_signals')
+@with_appcontext
+@click.option('-t', '--threads', type=int, help='The number of parallel workers per signal type.')
+@click.option('-b', '--burst-count', type=int, help='The maximum number of signals sent in one transaction.')
+@click.option('-w', '--wait', type=float, help='The minimum age (in seconds) of the signals to send.')
+@click.option('-l', '--listen', is_flag=True, help='Keep running, and send new signals as they arrive.')
+@click.option('-s', '--sweep-interval', type=float, help='The number of seconds between full sweeps.')
+@click.argument('signal_names', nargs=-1)
+def flush_signals(signal_names, threads, burst_count, wait, listen, sweep_interval):
+    """Send pending signals over the message bus.
+
+    If a list of SIGNAL_NAMES is specified, flushes only those
+    signals. If no SIGNAL_NAMES are specified, flushes all
+    signals. Signals addressed to other services' queues (like
+    "prepare_transfer" requests to swpt_accounts) are flushed first.
+
+    All signal types are flushed in parallel, each by several
+    parallel workers claiming bursts of signals with "FOR UPDATE SKIP
+    LOCKED", so that multiple processes can run this command in
+    parallel too. Each burst is published in a single AMQP
+    transaction. If not specified, the values of the environment
+    variables APP_FLUSH_SIGNALS_THREADS (default 4),
+    APP_SIGNALBUS_BURST_COUNT (default 100), and
+    APP_FLUSH_SIGNALS_WAIT (default 0 seconds) are taken. Signals
+    younger than the given number of seconds are not sent. When
+    auto-flushing is enabled (APP_SIGNALBUS_AUTOFLUSH), a wait of few
+    seconds allows the auto-flushing senders to complete.
+
+    When the "--listen" flag is given, the command never exits.
+    Instead, it waits for the database to notify it about newly
+    inserted signals, and sends them as soon as they become old
+    enough. Additionally, all signal tables are swept periodically. If
+    the sweep interval is not specified, the value of the environment
+    variable APP_FLUSH_SIGNALS_SWEEP_INTERVAL is taken. If it is not
+    set, the default interval is 60 seconds.
+
+    """
+
+    threads = threads or int(environ.get('APP_FLUSH_SIGNALS_THREADS', '4'))
+    wait = float(environ.get('APP_FLUSH_SIGNALS_WAIT', '0')) if wait is None else wait
+    signal_models = _get_signal_models(signal_names)
+    try:
+        if listen:  # pragma: no cover
+            sweep_interval = sweep_interval or float(environ.get('APP_FLUSH_SIGNALS_SWEEP_INTERVAL', '60'))
+            _listen_for_signals(signal_models, threads, burst_count, wait, sweep_interval)
+        else:
+            cutoff_ts = datetime.now(tz=timezone.utc) - timedelta(seconds=wait)
+            n = _flush_signal_models(signal_models, cutoff_ts, threads, burst_count)
+            _report_sent_signals(n)
+    finally:
+        _shutdown_flushing_workers()
+
+
+def _get_signal_models(signal_names):
+    signal_models = db.signalbus.get_signal_models()
+    if signal_names:
+        for name in set(signal_names) - {m.__name__ for m in signal_models}:
+            click.echo(f'Warning: A signal with name "{name}" does not exist.')
+        signal_models = [m for m in signal_models if m.__name__ in signal_names]
+
+    # The workers of the signals that come first get started first.
+    return sorted(signal_models, key=lambda m: m.queue_name is None)
+
+
+class _FlushingWorkers:
+    """A pool of long-lived threads that flush signals.
+
+    Each thread publishes over its own connection to the broker. The
+    threads are reused by all flushes in the process, so that new
+    connections are not opened every time, and the connections are
+    closed when the pool is shut down.
+
+    """
+
+    def __init__(self, app, size):
+        self.app = app
+        self.size = size
+        self._jobs = queue.Queue()
+        self._threads = [threading.Thread(target=self._run, daemon=True) for _ in range(size)]
+        for thread in self._threads:
+            thread.start()
+
+    def map(self, fn, args):
+        futures = []
+        for arg in args:
+            future = Future()
+            self._jobs.put((future, fn, arg))
+            futures.append(future)
+        return [future.result() for future in futures]
+
+    def shutdown(self):
+        for _ in self._threads:
+            self._jobs.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def _run(self):
+        try:
+            while True:
+                job = self._jobs.get()
+                if job is None:
+                    break
+                future, fn, arg = job
+                try:
+                    with self.app.app_context():
+                        future.set_result(fn(arg))
+                except BaseException as e:
+                    future.set_exception(e)
+        finally:
+            close_publishing_connection()
+
+
+_flushing_workers = None
+
+
+def _get_flushing_workers(size):
+    global _flushing_workers
+    if _flushing_workers is None:
+        _flushing_workers = _FlushingWorkers(current_app._get_current_object(), size)
+    return _flushing_workers
+
+
+def _shutdown_flushing_workers():
+    global _flushing_workers
+    if _flushing_workers is not None:
+        _flushing_workers.shutdown()
+        _flushing_workers = None
+
+
+def _get_db_pool_capacity():
+    # When not configured, SQLAlchemy's defaults (5 and 10) are used.
+    config = current_app.config
+    pool_size = config.get('SQLALCHEMY_POOL_SIZE') or 5
+    max_overflow = config.get('SQLALCHEMY_MAX_OVERFLOW')
+    max_overflow = 10 if max_overflow is None else max_overflow
+    return None if max_overflow < 0 else pool_size + max_overflow
+
+
+def _flush_signal_models(signal_models, cutoff_ts, threads, burst_count):
+    def flush(signal_model):
+        max_count = burst_count or signal_model.signalbus_burst_count
+        n = 0
+        while True:
+            count = procedures.flush_signals(signal_model, cutoff_ts, max_count)
+            n += count
+            if count < max_count:
+                return n
+
+    # Each signal type gets its own workers, so that the signal types
+    # are flushed in parallel with each other too. The number of
+    # threads is limited by the size of the database connection pool,
+    # so that the threads do not wait for connections.
+    jobs = [m for m in signal_models for _ in range(threads)]
+    if len(jobs) > 1:
+        db_pool_capacity = _get_db_pool_capacity() or len(jobs)
+        workers = _get_flushing_workers(min(len(jobs), db_pool_capacity))
+        return sum(workers.map(flush, jobs))
+    return sum(flush(m) for m in jobs)
+
+
+def _listen_for_signals(signal_models, threads, burst_count, wait, sweep_interval):  # pragma: no cover
+    signal_models_by_table_name = {m.__tablename__: m for m in signal_models}
+    # The listening connection must not be returned to the pool.
+    pooled_connection = db.engine.raw_connection()
+    pooled_connection.detach()
+    connection = pooled_connection.connection
+    connection.autocommit = True
+    with connection.cursor() as cursor:
+        cursor.execute(f'LISTEN {SIGNAL_NOTIFICATION_CHANNEL}')
+
+    # For each signal model, we keep the time at which the signals
+    # about which we have been notified will become old enough to be
+    # sent, and the time of the last notification.
+    deadlines = {}
+    notified_at = {}
+    next_sweep_time = time.monotonic()
+    while True:
+        now = time.monotonic()
+        if now >= next_sweep_time:
+            next_sweep_time = now + sweep_interval
+            models_to_flush = signal_models
+        else:
+            models_to_flush = [m for m in signal_models if deadlines.get(m, next_sweep_time) <= now]
+
+        # Signals about which we have been notified during the last
+        # `wait` seconds are too young to be sent now, so for them, a
+        # new deadline is set.
+        for m in models_to_flush:
+            if m in deadlines:
+                if notified_at[m] > now - wait:
+                    deadlines[m] = notified_at[m] + wait
+                else:
+                    del deadlines[m]
+        if models_to_flush:
+            cutoff_ts = datetime.now(tz=timezone.utc) - timedelta(seconds=wait)
+            _report_sent_signals(_flush_signal_models(models_to_flush, cutoff_ts, threads, burst_count))
+
+        timeout = min([next_sweep_time, *deadlines.values()]) - time.monotonic()
+        if select.select([connection], [], [], max(timeout, 0.0)) != ([], [], []):
+            connection.poll()
+            now = time.monotonic()
+            for notification in connection.notifies:
+                m = signal_models_by_table_name.get(notification.payload)
+                if m is not None:
+                    deadlines.setdefault(m, now + wait)
+                    notified_at[m] = now
+            connection.notifies.clear()
+
+
+def _report_sent_signals(n):
+    if n == 1:
+        click.echo(f'1 signal has been sent.')
+    elif n > 1:  # pragma: nocover
+        click.echo(f'{n} signals have been sent.')
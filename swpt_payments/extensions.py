@@ -1,14 +1,34 @@
 import os
 import warnings
+import threading
+from typing import List, Sequence, Tuple
+import pika
+import dramatiq
 from sqlalchemy.exc import SAWarning
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flask_signalbus import SignalBusMixin, AtomicProceduresMixin
 from flask_melodramatiq import RabbitmqBroker
-from dramatiq import Middleware
+from dramatiq import Middleware, set_encoder
+from dramatiq.encoder import JSONEncoder, MessageData
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
 
 MAIN_EXCHANGE_NAME = 'dramatiq'
 APP_QUEUE_NAME = os.environ.get('APP_QUEUE_NAME', 'swpt_payments')
+APP_QUEUE_SHARDS = int(os.environ.get('APP_QUEUE_SHARDS', '1'))
+APP_USE_LOAD_BALANCING_EXCHANGE = os.environ.get('APP_USE_LOAD_BALANCING_EXCHANGE', '') not in ['', 'False']
+APP_LOAD_BALANCING_QUEUE_WEIGHTS = [
+    int(w) for w in os.environ.get('APP_LOAD_BALANCING_QUEUE_WEIGHTS', '1').split(',')
+]
 
 warnings.filterwarnings(
     'ignore',
@@ -21,6 +41,31 @@ class CustomAlchemy(AtomicProceduresMixin, SignalBusMixin, SQLAlchemy):
     pass
 
 
+class FastJSONEncoder(JSONEncoder):
+    """Encodes messages as JSON, using `orjson` when it is installed.
+
+    The produced messages are compatible with dramatiq's default JSON
+    encoder, so that other services do not need to be changed. When
+    `msgpack` is installed, msgpack-encoded messages can be decoded as
+    well.
+
+    """
+
+    def encode(self, data: MessageData) -> bytes:
+        if orjson is None:  # pragma: no cover
+            return super().encode(data)
+        return orjson.dumps(data)
+
+    def decode(self, data: bytes) -> MessageData:
+        # A JSON-encoded message always starts with "{", while a
+        # msgpack-encoded message always starts with a map header.
+        if msgpack is not None and data[:1] != b'{':
+            return msgpack.unpackb(data, raw=False)
+        if orjson is None:  # pragma: no cover
+            return super().decode(data)
+        return orjson.loads(data)
+
+
 class EventSubscriptionMiddleware(Middleware):
     @property
     def actor_options(self):
@@ -31,3 +76,161 @@ db = CustomAlchemy()
 migrate = Migrate()
 broker = RabbitmqBroker(confirm_delivery=True)
 broker.add_middleware(EventSubscriptionMiddleware())
+set_encoder(FastJSONEncoder())
+_thread_local = threading.local()
+
+
+def publish_messages(messages: Sequence[Tuple[dramatiq.Message, str]], *, exchange: str = '') -> None:
+    """Publish a burst of messages on an exchange, in one AMQP transaction.
+
+    `messages` is a sequence of `(message, routing_key)` pairs. Unlike
+    `broker.publish_message()`, which waits for a publisher confirm
+    after each message, this waits only once, for the whole burst.
+
+    """
+
+    attempts = 1
+    while True:
+        try:
+            channel = _get_transactional_channel()
+            for message, routing_key in messages:
+                channel.basic_publish(
+                    exchange=exchange,
+                    routing_key=routing_key,
+                    body=message.encode(),
+                    properties=pika.BasicProperties(
+                        delivery_mode=2,
+                        priority=message.options.get('broker_priority'),
+                    ),
+                )
+            channel.tx_commit()
+            return
+
+        except (pika.exceptions.AMQPConnectionError, pika.exceptions.AMQPChannelError) as e:
+            # Nothing has been published, because the transaction has
+            # not been committed. (If the connection has been lost
+            # during the commit, some messages may be sent twice.)
+            _thread_local.__dict__.pop('channel', None)
+            del broker.channel
+            del broker.connection
+
+            attempts += 1
+            if attempts > 6:
+                raise dramatiq.ConnectionClosed(e) from None
+
+
+def close_publishing_connection() -> None:
+    """Close the current thread's connection to the broker.
+
+    The broker keeps a separate connection for each thread that calls
+    `publish_messages()`, and never closes it by itself. Therefore,
+    threads that publish messages should call this before they exit.
+
+    """
+
+    _thread_local.__dict__.pop('channel', None)
+    connection = getattr(broker.state, 'connection', None)
+    del broker.channel
+    del broker.connection
+    if connection is not None and connection.is_open:
+        try:
+            connection.close()
+        except pika.exceptions.AMQPError:  # pragma: no cover
+            pass
+
+
+def _get_transactional_channel():
+    channel = getattr(_thread_local, 'channel', None)
+    if channel is None:
+        channel = _thread_local.channel = broker.connection.channel()
+        channel.tx_select()
+    return channel
+
+
+def make_psycopg2_green() -> bool:
+    """Make psycopg2 yield to other greenlets while waiting for the database.
+
+    Does nothing unless gevent has monkey-patched the standard library
+    (`dramatiq-gevent` does this before importing the app). Returns
+    whether the wait callback has been installed.
+
+    """
+
+    try:
+        from gevent import monkey
+    except ImportError:  # pragma: no cover
+        return False
+    if not monkey.is_module_patched('socket'):
+        return False
+
+    import psycopg2.extensions
+    psycopg2.extensions.set_wait_callback(_gevent_wait_callback)
+    return True
+
+
+def _gevent_wait_callback(conn, timeout=None):  # pragma: no cover
+    import psycopg2.extensions
+    from gevent.socket import wait_read, wait_write
+
+    while True:
+        state = conn.poll()
+        if state == psycopg2.extensions.POLL_OK:
+            break
+        elif state == psycopg2.extensions.POLL_READ:
+            wait_read(conn.fileno(), timeout=timeout)
+        elif state == psycopg2.extensions.POLL_WRITE:
+            wait_write(conn.fileno(), timeout=timeout)
+        else:
+            raise psycopg2.OperationalError(f'Bad result from poll: {state}')
+
+
+def get_shard_queue_names(queue_name: str = APP_QUEUE_NAME, shards: int = APP_QUEUE_SHARDS) -> List[str]:
+    """Return the names of the queues among which messages are sharded."""
+
+    assert shards > 0
+    if shards == 1:
+        return [queue_name]
+    return [f'{queue_name}.{i}' for i in range(shards)]
+
+
+def get_shard_queue_name(creditor_id: int, queue_name: str = APP_QUEUE_NAME, shards: int = APP_QUEUE_SHARDS) -> str:
+    """Return the name of the queue to which messages concerning a given
+    payee (`payee_creditor_id`, `coordinator_id`) should be sent.
+
+    Publishers should use the returned name both as a routing key, and
+    as a queue name for the message. The shards are assigned with a
+    consistent hash, so that when the number of shards changes, only
+    a small part of the payees get moved to another shard.
+
+    """
+
+    return get_shard_queue_names(queue_name, shards)[_jump_consistent_hash(creditor_id, shards)]
+
+
+def get_partition_queue_names(
+        queue_name: str = APP_QUEUE_NAME,
+        weights: List[int] = APP_LOAD_BALANCING_QUEUE_WEIGHTS) -> List[str]:
+    """Return the names of the queues behind the load-balancing exchange."""
+
+    assert len(weights) > 0 and all(w > 0 for w in weights)
+    return [f'{queue_name}.p{i}' for i in range(len(weights))]
+
+
+def get_consumed_queue_names() -> List[str]:
+    """Return the names of the queues from which the workers consume."""
+
+    if APP_USE_LOAD_BALANCING_EXCHANGE:
+        return get_partition_queue_names()
+    return get_shard_queue_names()
+
+
+def _jump_consistent_hash(key: int, num_buckets: int) -> int:
+    # See "A Fast, Minimal Memory, Consistent Hash Algorithm" by John
+    # Lamping and Eric Veach.
+    key &= 0xffffffffffffffff
+    b, j = -1, 0
+    while j < num_buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xffffffffffffffff
+        j = int((b + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return b
@@ -1,37 +1,144 @@
+import os
 import datetime
 import dramatiq
+from functools import lru_cache
 from base64 import urlsafe_b64encode
-from marshmallow import Schema, fields
+from marshmallow import Schema, fields, missing
+from sqlalchemy import event
+from sqlalchemy.orm import Session
 from sqlalchemy.dialects import postgresql as pg
 from sqlalchemy.sql.expression import func, null, or_, and_
-from .extensions import db, broker, MAIN_EXCHANGE_NAME
+from .extensions import db, broker, publish_messages, MAIN_EXCHANGE_NAME
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
 
 MIN_INT32 = -1 << 31
 MAX_INT32 = (1 << 31) - 1
 MIN_INT64 = -1 << 63
 MAX_INT64 = (1 << 63) - 1
+SIGNALBUS_BURST_COUNT = int(os.environ.get('APP_SIGNALBUS_BURST_COUNT', '100'))
+SIGNALBUS_AUTOFLUSH = os.environ.get('APP_SIGNALBUS_AUTOFLUSH', 'True') not in ['', 'False']
+
+# When this is set, all signals are written to the `outgoing_message`
+# table, instead of to their own tables.
+USE_OUTBOX = os.environ.get('APP_USE_OUTBOX', '') not in ['', 'False']
+
+# Database triggers send a notification on this channel, with the
+# name of the table as payload, whenever rows are inserted into a
+# signal table.
+SIGNAL_NOTIFICATION_CHANNEL = 'swpt_payments_signals'
+
+# Signals sent to those queues are encoded with msgpack, instead of
+# JSON. The consumers of the queues must be able to decode msgpack.
+MSGPACK_QUEUES = {q for q in os.environ.get('APP_MSGPACK_QUEUES', '').split(',') if q}
+if MSGPACK_QUEUES and msgpack is None:  # pragma: no cover
+    raise RuntimeError('APP_MSGPACK_QUEUES is set, but msgpack is not installed.')
 
 
 def get_now_utc():
     return datetime.datetime.now(tz=datetime.timezone.utc)
 
 
+class MsgpackMessage(dramatiq.Message):
+    """A message that is always encoded with msgpack."""
+
+    def encode(self):
+        return msgpack.packb(self._asdict(), use_bin_type=True)
+
+
+@lru_cache(maxsize=None)
+def get_signal_dumper(model):
+    """Return a function that does the same as `model.__marshmallow_schema__.dump`, only faster.
+
+    The most common field types are serialized directly, without
+    going through marshmallow's machinery.
+
+    """
+
+    def make_getter(attr, default, serialize):
+        def get(obj):
+            value = getattr(obj, attr, default)
+            return value if value is None or value is missing else serialize(value)
+        return get
+
+    getters = []
+    for name, field in model.__marshmallow_schema__.fields.items():
+        serialize = _get_fast_serializer(field)
+        if serialize:
+            get = make_getter(field.attribute or name, field.default, serialize)
+        else:
+            get = lambda obj, name=name, field=field: field.serialize(name, obj)  # noqa: E731
+        getters.append((field.data_key or name, get))
+
+    def dump(obj):
+        data = {}
+        for key, get in getters:
+            value = get(obj)
+            if value is not missing:
+                data[key] = value
+        return data
+
+    return dump
+
+
+_FAST_SERIALIZERS = {
+    fields.Integer: int,
+    fields.String: str,
+    fields.Raw: lambda value: value,
+    fields.DateTime: lambda value: value.isoformat(),
+}
+
+
+def _get_fast_serializer(field):
+    if callable(field.default):
+        return None
+    if isinstance(field, fields.Number) and field.as_string:
+        return None
+    if isinstance(field, fields.DateTime) and field.format not in [None, 'iso']:
+        return None
+    return _FAST_SERIALIZERS.get(type(field))
+
+
 class Signal(db.Model):
     __abstract__ = True
 
-    # TODO: Define `send_signalbus_messages` class method, set
-    #      `ModelClass.signalbus_autoflush = False` and
-    #      `ModelClass.signalbus_burst_count = N` in models. Make sure
-    #      TTL is set properly for the messages.
+    # TODO: Make sure TTL is set properly for the messages.
 
+    # Sending the signals after each transaction commit delays the
+    # processing of the next message by the worker. Therefore, when a
+    # `flask swpt_payments flush_signals --listen` process is known to
+    # be running, APP_SIGNALBUS_AUTOFLUSH should be set to "False".
+    # Then the procedures only record the signals, and the listening
+    # process sends them as soon as they have been committed.
     queue_name = None
+    signalbus_autoflush = SIGNALBUS_AUTOFLUSH and not USE_OUTBOX
+    signalbus_burst_count = SIGNALBUS_BURST_COUNT
 
     @property
-    def event_name(self):  # pragma: no cover
+    def event_name(self):
         model = type(self)
         return f'on_{model.__tablename__}'
 
     def send_signalbus_message(self):  # pragma: no cover
+        message, routing_key = self._create_message()
+        broker.publish_message(message, exchange=MAIN_EXCHANGE_NAME, routing_key=routing_key)
+
+    def create_outgoing_message(self):
+        if self.inserted_at_ts is None:
+            self.inserted_at_ts = get_now_utc()
+        message, routing_key = self._create_message()
+        return OutgoingMessage(
+            routing_key=routing_key,
+            target_queue=message.queue_name,
+            actor_name=message.actor_name,
+            payload=message.encode(),
+            inserted_at_ts=self.inserted_at_ts,
+        )
+
+    def _create_message(self):
         model = type(self)
         if model.queue_name is None:
             assert not hasattr(model, 'actor_name'), \
@@ -41,19 +148,41 @@ class Signal(db.Model):
         else:
             actor_name = model.actor_name
             routing_key = model.queue_name
-        data = model.__marshmallow_schema__.dump(self)
-        message = dramatiq.Message(
+        data = get_signal_dumper(model)(self)
+        message_class = MsgpackMessage if model.queue_name in MSGPACK_QUEUES else dramatiq.Message
+        message = message_class(
             queue_name=model.queue_name,
             actor_name=actor_name,
             args=(),
             kwargs=data,
             options={},
         )
-        broker.publish_message(message, exchange=MAIN_EXCHANGE_NAME, routing_key=routing_key)
+        return message, routing_key
+
+    @classmethod
+    def send_signalbus_messages(cls, objects):
+        publish_messages([obj._create_message() for obj in objects], exchange=MAIN_EXCHANGE_NAME)
 
     inserted_at_ts = db.Column(db.TIMESTAMP(timezone=True), nullable=False, default=get_now_utc)
 
 
+class DescriptionBlob(db.Model):
+    description_hash = db.Column(
+        pg.BYTEA,
+        primary_key=True,
+        comment='The SHA-256 hash of the canonical JSON serialization of the description.',
+    )
+    description = db.Column(pg.JSONB, nullable=False)
+    __table_args__ = (
+        {
+            'comment': 'Represents a description of goods or services. Descriptions are '
+                       'immutable, and are shared between offers and payment proofs. A '
+                       'description that is not referenced by any offer or payment proof '
+                       'can be deleted.',
+        },
+    )
+
+
 class FormalOffer(db.Model):
     payee_creditor_id = db.Column(
         db.BigInteger,
@@ -86,11 +215,12 @@ class FormalOffer(db.Model):
                 'some or all of the `debtor_amounts` elements to be `NULL` or negative '
                 'numbers, which should be handled as if they were zeros.',
     )
-    description = db.Column(
-        pg.JSON,
-        comment='A more or less detailed description of the goods or services that will be '
-                'supplied if a payment is made to the offer. `NULL` means that the payee '
-                'has no responsibilities whatsoever.',
+    description_hash = db.Column(
+        pg.BYTEA,
+        db.ForeignKey('description_blob.description_hash'),
+        comment='Refers to a more or less detailed description of the goods or services that '
+                'will be supplied if a payment is made to the offer. `NULL` means that the '
+                'payee has no responsibilities whatsoever.',
     )
     reciprocal_payment_debtor_id = db.Column(
         db.BigInteger,
@@ -110,7 +240,16 @@ class FormalOffer(db.Model):
         comment='The offer will not be valid after this deadline.'
     )
     created_at_ts = db.Column(db.TIMESTAMP(timezone=True), nullable=False, default=get_now_utc)
+    document = db.Column(
+        pg.BYTEA,
+        comment='The JSON-LD document representing the offer, rendered when the offer was '
+                'created, without the `offerDescription` property. `NULL` means that the '
+                'document should be rendered on request.',
+    )
+    document_etag = db.Column(db.String, comment='The entity tag of the JSON-LD document.')
     __table_args__ = (
+        db.Index('idx_formal_offer_valid_until_ts', valid_until_ts),
+        db.Index('idx_formal_offer_description_hash', description_hash),
         db.CheckConstraint(func.array_ndims(debtor_ids) == 1),
         db.CheckConstraint(func.array_ndims(debtor_amounts) == 1),
         db.CheckConstraint(func.cardinality(debtor_ids) == func.cardinality(debtor_amounts)),
@@ -163,7 +302,7 @@ class PaymentOrder(db.Model):
         comment='A copy of the corresponding `formal_offer.reciprocal_payment_amount`.',
     )
     payer_note = db.Column(
-        pg.JSON,
+        pg.JSONB,
         default={},
         comment='A note from the payer. Can be anything that the payer wants the payee to see.'
                 'If the payment is successful, the content of this column will be copied over to '
@@ -202,6 +341,12 @@ class PaymentOrder(db.Model):
                 'negative number). `coordinator_id` should be `payee_creditor_id`. '
                 '`coordinator_type` should be "payment".',
     )
+    created_at_ts = db.Column(
+        db.TIMESTAMP(timezone=True),
+        nullable=False,
+        default=get_now_utc,
+        comment='The moment at which the payment order was created.',
+    )
     finalized_at_ts = db.Column(
         db.TIMESTAMP(timezone=True),
         comment='The moment at which the payment order was finalized. NULL means that the '
@@ -215,6 +360,19 @@ class PaymentOrder(db.Model):
             payment_coordinator_request_id,
             unique=True,
         ),
+        db.Index(
+            'idx_payment_order_unfinalized',
+            payee_creditor_id,
+            offer_id,
+            postgresql_where=finalized_at_ts == null(),
+        ),
+        db.Index(
+            'idx_payment_order_unfinalized_created_at_ts',
+            created_at_ts,
+            payee_creditor_id,
+            payment_coordinator_request_id,
+            postgresql_where=finalized_at_ts == null(),
+        ),
         db.CheckConstraint(amount >= 0),
         db.CheckConstraint(reciprocal_payment_amount >= 0),
         db.CheckConstraint(payment_coordinator_request_id > 0),
@@ -247,14 +405,28 @@ class PaymentProof(db.Model):
         comment='The ID of the debtor through which the payment went.',
     )
     amount = db.Column(db.BigInteger, nullable=False)
-    payer_note = db.Column(pg.JSON, nullable=False, default={})
+    payer_note = db.Column(pg.JSONB, nullable=False, default={})
     paid_at_ts = db.Column(db.TIMESTAMP(timezone=True), nullable=False, default=get_now_utc)
     reciprocal_payment_debtor_id = db.Column(db.BigInteger)
     reciprocal_payment_amount = db.Column(db.BigInteger, nullable=False)
     offer_id = db.Column(db.BigInteger, nullable=False)
     offer_created_at_ts = db.Column(db.TIMESTAMP(timezone=True), nullable=False)
-    offer_description = db.Column(pg.JSON)
+    offer_description_hash = db.Column(
+        pg.BYTEA,
+        db.ForeignKey('description_blob.description_hash'),
+        comment='A copy of the corresponding `formal_offer.description_hash`.',
+    )
+    document = db.Column(
+        pg.BYTEA,
+        comment='The JSON-LD document representing the proof, rendered when the proof was '
+                'created, without the `offerDescription` property. `NULL` means that the '
+                'document should be rendered on request.',
+    )
+    document_etag = db.Column(db.String, comment='The entity tag of the JSON-LD document.')
     __table_args__ = (
+        db.Index('idx_payment_proof_offer_description_hash', offer_description_hash),
+        db.Index('idx_payment_proof_payer_creditor_id', payer_creditor_id, proof_id),
+        db.Index('idx_payment_proof_paid_at_ts', payee_creditor_id, paid_at_ts, proof_id),
         db.CheckConstraint(amount >= 0),
         db.CheckConstraint(reciprocal_payment_amount >= 0),
         db.CheckConstraint(or_(
@@ -306,7 +478,7 @@ class FailedReciprocalPaymentSignal(Signal):
 
     payee_creditor_id = db.Column(db.BigInteger, primary_key=True)
     offer_id = db.Column(db.BigInteger, primary_key=True)
-    details = db.Column(pg.JSON, nullable=False, default={})
+    details = db.Column(pg.JSONB, nullable=False, default={})
 
 
 class SuccessfulPaymentSignal(Signal):
@@ -331,7 +503,7 @@ class SuccessfulPaymentSignal(Signal):
     payer_payment_order_seqnum = db.Column(db.Integer, primary_key=True)
     debtor_id = db.Column(db.BigInteger, nullable=False)
     amount = db.Column(db.BigInteger, nullable=False)
-    payer_note = db.Column(pg.JSON, nullable=False)
+    payer_note = db.Column(pg.JSONB, nullable=False)
     paid_at_ts = db.Column(db.TIMESTAMP(timezone=True), nullable=False)
     reciprocal_payment_debtor_id = db.Column(db.BigInteger)
     reciprocal_payment_amount = db.Column(db.BigInteger, nullable=False)
@@ -360,7 +532,7 @@ class FailedPaymentSignal(Signal):
     offer_id = db.Column(db.BigInteger, primary_key=True)
     payer_creditor_id = db.Column(db.BigInteger, primary_key=True)
     payer_payment_order_seqnum = db.Column(db.Integer, primary_key=True)
-    details = db.Column(pg.JSON, nullable=False, default={})
+    details = db.Column(pg.JSONB, nullable=False, default={})
 
 
 class PrepareTransferSignal(Signal):
@@ -408,7 +580,51 @@ class FinalizePreparedTransferSignal(Signal):
     sender_creditor_id = db.Column(db.BigInteger, nullable=False)
     transfer_id = db.Column(db.BigInteger, nullable=False)
     committed_amount = db.Column(db.BigInteger, nullable=False)
-    transfer_info = db.Column(pg.JSON, nullable=False)
+    transfer_info = db.Column(pg.JSONB, nullable=False)
     __table_args__ = (
         db.CheckConstraint(committed_amount >= 0),
     )
+
+
+class OutgoingMessage(Signal):
+    """Contains an already serialized signal of any type.
+
+    Used instead of the per-type signal tables when `APP_USE_OUTBOX`
+    is set. The messages are sent in the order of their insertion.
+
+    """
+
+    message_id = db.Column(db.BigInteger, primary_key=True, autoincrement=True)
+    routing_key = db.Column(db.String, nullable=False)
+    target_queue = db.Column(db.String, comment='The `queue_name` of the encoded dramatiq message.')
+    actor_name = db.Column(db.String, nullable=False)
+    payload = db.Column(pg.BYTEA, nullable=False, comment='The encoded dramatiq message.')
+    __table_args__ = (
+        {
+            'comment': 'Represents a signal which is waiting to be sent.',
+        },
+    )
+
+    def _create_message(self):
+        return _EncodedMessage(self.payload), self.routing_key
+
+
+OutgoingMessage.signalbus_order_by = (OutgoingMessage.message_id,)
+
+
+class _EncodedMessage:
+    def __init__(self, body):
+        self.body = body
+        self.options = {}
+
+    def encode(self):
+        return self.body
+
+
+@event.listens_for(Session, 'before_flush')
+def _move_signals_to_outbox(session, flush_context, instances):
+    if USE_OUTBOX:
+        for obj in list(session.new):
+            if isinstance(obj, Signal) and not isinstance(obj, OutgoingMessage):
+                session.expunge(obj)
+                session.add(obj.create_outgoing_message())
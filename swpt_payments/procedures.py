@@ -1,29 +1,225 @@
 import os
+import json
+import time
+import logging
+import hashlib
+import threading
+from collections import OrderedDict
+from functools import lru_cache
 from datetime import datetime, timezone
-from typing import Optional, List, Tuple, TypeVar, Callable
+from typing import Optional, List, Tuple, TypeVar, Callable, Type, Hashable, Dict, Iterable
+from sqlalchemy.orm import defer, make_transient_to_detached
+from sqlalchemy.sql.expression import select, exists, literal, literal_column, func, and_, tuple_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from .extensions import db
 from .models import FormalOffer, CreatedFormalOfferSignal, PaymentOrder, FinalizePreparedTransferSignal, \
     CanceledFormalOfferSignal, PrepareTransferSignal, FailedPaymentSignal, SuccessfulPaymentSignal, \
-    PaymentProof, FailedReciprocalPaymentSignal, MIN_INT64, MAX_INT64
+    PaymentProof, FailedReciprocalPaymentSignal, DescriptionBlob, Signal, MIN_INT64, MAX_INT64
+from .schemas import render_offer, render_proof
 
 T = TypeVar('T')
 atomic: Callable[[T], T] = db.atomic
 
+DESCRIPTION_CACHE_SIZE = int(os.environ.get('APP_DESCRIPTION_CACHE_SIZE', '1000'))
+MAX_OFFER_DESCRIPTION_BYTES = int(os.environ.get('APP_MAX_OFFER_DESCRIPTION_BYTES', '10000'))
+MAX_PAYER_NOTE_BYTES = int(os.environ.get('APP_MAX_PAYER_NOTE_BYTES', '1000'))
+PAYMENT_ORDER_CACHE_SIZE = int(os.environ.get('APP_PAYMENT_ORDER_CACHE_SIZE', '10000'))
+PAYMENT_ORDER_CACHE_TTL = float(os.environ.get('APP_PAYMENT_ORDER_CACHE_TTL', '300'))
+NEGATIVE_CACHE_SIZE = int(os.environ.get('APP_NEGATIVE_CACHE_SIZE', '10000'))
+NEGATIVE_CACHE_TTL = float(os.environ.get('APP_NEGATIVE_CACHE_TTL', '5'))
+CACHE_STATS_LOG_INTERVAL = float(os.environ.get('APP_CACHE_STATS_LOG_INTERVAL', '600'))
+
+_logger = logging.getLogger(__name__)
+
+
+class ExpiringKeyCache:
+    """A bounded, thread-safe set of keys that expire after `ttl` seconds.
+
+    When the cache is full, the oldest keys are evicted first. Lookups
+    are counted in the `hits` and `misses` attributes, and the
+    statistics are logged every `CACHE_STATS_LOG_INTERVAL` seconds.
+
+    """
+
+    def __init__(self, maxsize: int, ttl: float, name: str = 'cache'):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self._expiry_times: 'OrderedDict[Hashable, float]' = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats_logged_at = time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self._expiry_times)
+
+    def __contains__(self, key: Hashable) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            expiry_time = self._expiry_times.get(key)
+            is_hit = expiry_time is not None and expiry_time > now
+            if is_hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+            must_log_stats = now - self._stats_logged_at >= CACHE_STATS_LOG_INTERVAL
+            if must_log_stats:
+                self._stats_logged_at = now
+
+        if must_log_stats:
+            _logger.info('%s: %s', self.name, self.get_stats())
+        return is_hit
+
+    def add(self, key: Hashable) -> None:
+        # Keys that would expire immediately are not worth storing.
+        if self.maxsize <= 0 or self.ttl <= 0:
+            return
+        now = time.monotonic()
+        with self._lock:
+            expiry_times = self._expiry_times
+            expiry_times.pop(key, None)
+            expiry_times[key] = now + self.ttl
+
+            # All keys live equally long, so the keys that expire first
+            # are always at the beginning.
+            while expiry_times and (len(expiry_times) > self.maxsize or next(iter(expiry_times.values())) <= now):
+                expiry_times.popitem(last=False)
+
+    def discard(self, key: Hashable) -> None:
+        with self._lock:
+            self._expiry_times.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._expiry_times.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def get_stats(self) -> Dict[str, int]:
+        return {'size': len(self), 'hits': self.hits, 'misses': self.misses}
+
+
+# Keys of recently processed payment order requests. This allows
+# re-delivered requests to be ignored without hitting the database.
+_recent_payment_orders = ExpiringKeyCache(PAYMENT_ORDER_CACHE_SIZE, PAYMENT_ORDER_CACHE_TTL, 'recent_payment_orders')
+
+# Keys of offers and proofs which were recently found to not exist.
+# Offer and proof IDs are never reused, and the keys are removed when
+# the corresponding rows get created. The TTL is kept short though,
+# because a lookup that started before a row has been committed, may
+# add the key after it has been removed.
+_missing_formal_offers = ExpiringKeyCache(NEGATIVE_CACHE_SIZE, NEGATIVE_CACHE_TTL, 'missing_formal_offers')
+_missing_payment_proofs = ExpiringKeyCache(NEGATIVE_CACHE_SIZE, NEGATIVE_CACHE_TTL, 'missing_payment_proofs')
+_caches = [_recent_payment_orders, _missing_formal_offers, _missing_payment_proofs]
+
+
+def get_cache_stats() -> Dict[str, Dict[str, int]]:
+    return {cache.name: cache.get_stats() for cache in _caches}
+
+
+def clear_caches() -> None:
+    for cache in _caches:
+        cache.clear()
+
 
 @atomic
-def get_formal_offer(payee_creditor_id: int, offer_id: int) -> FormalOffer:
-    return FormalOffer.query.filter_by(
+def get_formal_offer(payee_creditor_id: int, offer_id: int) -> Optional[FormalOffer]:
+    key = (payee_creditor_id, offer_id)
+    if key in _missing_formal_offers:
+        return None
+
+    formal_offer = FormalOffer.query.filter_by(
         payee_creditor_id=payee_creditor_id,
         offer_id=offer_id,
     ).one_or_none()
+    if formal_offer is None:
+        _missing_formal_offers.add(key)
+    return formal_offer
 
 
 @atomic
-def get_payment_proof(payee_creditor_id: int, proof_id: int) -> PaymentProof:
-    return PaymentProof.query.filter_by(
+def get_payment_proof(payee_creditor_id: int, proof_id: int) -> Optional[PaymentProof]:
+    key = (payee_creditor_id, proof_id)
+    if key in _missing_payment_proofs:
+        return None
+
+    payment_proof = PaymentProof.query.filter_by(
         payee_creditor_id=payee_creditor_id,
         proof_id=proof_id,
     ).one_or_none()
+    if payment_proof is None:
+        _missing_payment_proofs.add(key)
+    return payment_proof
+
+
+@atomic
+def get_payee_formal_offers(
+        payee_creditor_id: int,
+        max_count: int,
+        prev_offer_id: Optional[int] = None,
+        min_valid_until_ts: Optional[datetime] = None,
+        max_valid_until_ts: Optional[datetime] = None) -> List[FormalOffer]:
+    """Return up to `max_count` offers, ordered by their IDs, starting after `prev_offer_id`.
+
+    The pages are fetched by seeking in the primary key index, so that
+    fetching a page costs the same, no matter how deep it is.
+
+    """
+
+    query = FormalOffer.query.filter(FormalOffer.payee_creditor_id == payee_creditor_id)
+    if prev_offer_id is not None:
+        query = query.filter(FormalOffer.offer_id > prev_offer_id)
+    if min_valid_until_ts is not None:
+        query = query.filter(FormalOffer.valid_until_ts >= min_valid_until_ts)
+    if max_valid_until_ts is not None:
+        query = query.filter(FormalOffer.valid_until_ts < max_valid_until_ts)
+    return query.order_by(FormalOffer.offer_id).limit(max_count).all()
+
+
+@atomic
+def get_payer_payment_proofs(
+        payer_creditor_id: int,
+        max_count: int,
+        prev_proof_id: Optional[int] = None) -> List[PaymentProof]:
+    """Return up to `max_count` proofs, ordered by their IDs, starting after `prev_proof_id`.
+
+    All proof IDs are generated by the same sequence, so they are
+    unique even though the primary key includes the payee.
+
+    """
+
+    query = PaymentProof.query.filter(PaymentProof.payer_creditor_id == payer_creditor_id)
+    if prev_proof_id is not None:
+        query = query.filter(PaymentProof.proof_id > prev_proof_id)
+    return query.order_by(PaymentProof.proof_id).limit(max_count).all()
+
+
+@atomic
+def get_payee_payment_proofs(
+        payee_creditor_id: int,
+        max_count: int,
+        prev: Optional[Tuple[datetime, int]] = None,
+        min_paid_at_ts: Optional[datetime] = None,
+        max_paid_at_ts: Optional[datetime] = None) -> List[PaymentProof]:
+    """Return up to `max_count` proofs, ordered by `(paid_at_ts, proof_id)`, starting after `prev`."""
+
+    query = PaymentProof.query.filter(PaymentProof.payee_creditor_id == payee_creditor_id)
+    if prev is not None:
+        query = query.filter(tuple_(PaymentProof.paid_at_ts, PaymentProof.proof_id) > tuple_(*prev))
+    if min_paid_at_ts is not None:
+        query = query.filter(PaymentProof.paid_at_ts >= min_paid_at_ts)
+    if max_paid_at_ts is not None:
+        query = query.filter(PaymentProof.paid_at_ts < max_paid_at_ts)
+    return query.order_by(PaymentProof.paid_at_ts, PaymentProof.proof_id).limit(max_count).all()
+
+
+def get_description(description_hash: Optional[bytes]) -> Optional[dict]:
+    if description_hash is None:
+        return None
+
+    # Descriptions are immutable, so they can be safely cached.
+    return _get_description(bytes(description_hash))
 
 
 @atomic
@@ -43,20 +239,27 @@ def create_formal_offer(payee_creditor_id: int,
     assert reciprocal_payment_debtor_id is None or MIN_INT64 <= reciprocal_payment_debtor_id <= MAX_INT64
     assert 0 <= reciprocal_payment_amount <= MAX_INT64
 
+    is_description_too_big = description is not None and _get_json_size(description) > MAX_OFFER_DESCRIPTION_BYTES
     offer_secret = os.urandom(18)
     formal_offer = FormalOffer(
         payee_creditor_id=payee_creditor_id,
+        offer_id=_get_next_id(FormalOffer, 'formal_offer_offer_id_seq'),
         offer_secret=offer_secret,
         debtor_ids=debtor_ids,
         debtor_amounts=debtor_amounts,
         valid_until_ts=valid_until_ts,
-        description=description,
+        description_hash=None if is_description_too_big else _store_description(description),
         reciprocal_payment_debtor_id=reciprocal_payment_debtor_id,
         reciprocal_payment_amount=reciprocal_payment_amount,
         created_at_ts=datetime.now(tz=timezone.utc),
     )
-    db.session.add(formal_offer)
-    db.session.flush()
+
+    if not is_description_too_big:
+        # Offers never change, so their JSON-LD documents are rendered
+        # only once, before the offer is inserted.
+        formal_offer.document, formal_offer.document_etag = render_offer(formal_offer)
+        db.session.add(formal_offer)
+        _missing_formal_offers.discard((payee_creditor_id, formal_offer.offer_id))
     db.session.add(CreatedFormalOfferSignal(
         payee_creditor_id=payee_creditor_id,
         offer_id=formal_offer.offer_id,
@@ -64,6 +267,16 @@ def create_formal_offer(payee_creditor_id: int,
         offer_secret=offer_secret,
         offer_created_at_ts=formal_offer.created_at_ts,
     ))
+    if is_description_too_big:
+        # The payee waits for a `CreatedFormalOfferSignal`, so the
+        # offer can not be just ignored. Instead, the offer is
+        # canceled in the same transaction, without ever being
+        # inserted, so that it can not be seen without its
+        # description.
+        db.session.add(CanceledFormalOfferSignal(
+            payee_creditor_id=payee_creditor_id,
+            offer_id=formal_offer.offer_id,
+        ))
     return formal_offer
 
 
@@ -73,17 +286,28 @@ def cancel_formal_offer(payee_creditor_id: int, offer_id: int, offer_secret: byt
         payee_creditor_id=payee_creditor_id,
         offer_id=offer_id,
         offer_secret=offer_secret,
-    ).with_for_update().one_or_none()
+    ).options(defer(FormalOffer.document)).with_for_update().one_or_none()
     if formal_offer:
-        _abort_unfinalized_payment_orders(formal_offer)
-        db.session.add(CanceledFormalOfferSignal(
-            payee_creditor_id=payee_creditor_id,
-            offer_id=offer_id,
-        ))
-        db.session.delete(formal_offer)
+        _cancel_formal_offer(formal_offer)
+        _delete_unreferenced_descriptions([formal_offer.description_hash])
 
 
 @atomic
+def cancel_expired_formal_offers(cutoff_ts: datetime, max_count: int) -> int:
+    # Offers that are being paid or canceled at the moment are
+    # skipped. They will be processed by some of the next calls, if
+    # they still exist.
+    expired_offers = FormalOffer.query.filter(
+        FormalOffer.valid_until_ts < cutoff_ts,
+    ).order_by(FormalOffer.valid_until_ts).options(
+        defer(FormalOffer.document),
+    ).limit(max_count).with_for_update(skip_locked=True).all()
+    for formal_offer in expired_offers:
+        _cancel_formal_offer(formal_offer)
+    _delete_unreferenced_descriptions([fo.description_hash for fo in expired_offers])
+    return len(expired_offers)
+
+
 def make_payment_order(
         payee_creditor_id: int,
         offer_id: int,
@@ -94,6 +318,42 @@ def make_payment_order(
         amount: int,
         proof_secret: bytes,
         payer_note: dict = {}) -> None:
+    # A request that has been processed recently (successfully or
+    # not) can be safely ignored, because re-processing it would not
+    # change anything. For requests that are not in the cache, the
+    # database remains the authority.
+    key = (payee_creditor_id, offer_id, payer_creditor_id, payer_payment_order_seqnum)
+    if key in _recent_payment_orders:
+        return
+
+    _process_payment_order(
+        payee_creditor_id,
+        offer_id,
+        offer_secret,
+        payer_creditor_id,
+        payer_payment_order_seqnum,
+        debtor_id,
+        amount,
+        proof_secret,
+        payer_note,
+    )
+
+    # The key is added only after the transaction has been committed,
+    # so that a rolled back transaction can not hide a request.
+    _recent_payment_orders.add(key)
+
+
+@atomic
+def _process_payment_order(
+        payee_creditor_id: int,
+        offer_id: int,
+        offer_secret: bytes,
+        payer_creditor_id: int,
+        payer_payment_order_seqnum: int,
+        debtor_id: int,
+        amount: int,
+        proof_secret: bytes,
+        payer_note: dict) -> None:
     assert MIN_INT64 <= payee_creditor_id <= MAX_INT64
     assert MIN_INT64 <= offer_id <= MAX_INT64
     assert MIN_INT64 <= payer_creditor_id <= MAX_INT64
@@ -110,6 +370,27 @@ def make_payment_order(
             details=kw,
         ))
 
+    # Normally, the payment order is created by a single SQL
+    # statement, which performs all the necessary checks. Only if
+    # this fails, we go through the detailed checks one by one, so as
+    # to find out the reason for the failure.
+    is_payer_note_too_big = _get_json_size(payer_note) > MAX_PAYER_NOTE_BYTES
+    if not is_payer_note_too_big:
+        payment_order = _insert_payment_order(
+            payee_creditor_id,
+            offer_id,
+            offer_secret,
+            payer_creditor_id,
+            payer_payment_order_seqnum,
+            debtor_id,
+            amount,
+            proof_secret,
+            payer_note,
+        )
+        if payment_order:
+            _try_to_finalize_payment_order(payment_order)
+            return
+
     payment_order_query = PaymentOrder.query.filter_by(
         payee_creditor_id=payee_creditor_id,
         offer_id=offer_id,
@@ -122,17 +403,43 @@ def make_payment_order(
     # the request message has been re-delivered. We should ignore the
     # request in such cases.
     if not db.session.query(payment_order_query.exists()).scalar():
-        formal_offer = FormalOffer.query.filter_by(
+        if is_payer_note_too_big:
+            return failure(error_code='PAY008', message='The payer note is too big.')
+
+        # Offers that are known to not exist can be rejected without
+        # running the (locking) query below.
+        if (payee_creditor_id, offer_id) in _missing_formal_offers:
+            return failure(error_code='PAY001', message='The offer does not exist.')
+
+        # The payment options are validated by the database server, so
+        # that the `debtor_ids` and `debtor_amounts` arrays, which can
+        # be quite big, do not need to be loaded. The rendered
+        # document is not needed either.
+        row = db.session.query(
+            FormalOffer,
+            FormalOffer.debtor_ids.any(debtor_id),
+            _payment_option_exists(debtor_id, amount),
+        ).filter_by(
             payee_creditor_id=payee_creditor_id,
             offer_id=offer_id,
             offer_secret=offer_secret,
+        ).options(
+            defer(FormalOffer.debtor_ids),
+            defer(FormalOffer.debtor_amounts),
+            defer(FormalOffer.document),
         ).with_for_update(read=True).one_or_none()
 
-        if not formal_offer:
+        if not row:
+            # Unless the secret is wrong, repeated attempts to pay
+            # for this offer will not reach the database.
+            formal_offer_query = FormalOffer.query.filter_by(payee_creditor_id=payee_creditor_id, offer_id=offer_id)
+            if not db.session.query(formal_offer_query.exists()).scalar():
+                _missing_formal_offers.add((payee_creditor_id, offer_id))
             return failure(error_code='PAY001', message='The offer does not exist.')
-        if debtor_id is None or debtor_id not in formal_offer.debtor_ids:
+        formal_offer, is_valid_debtor_id, is_valid_amount = row
+        if debtor_id is None or not is_valid_debtor_id:
             return failure(error_code='PAY002', message='Invalid debtor ID.')
-        if (debtor_id, amount) not in zip(formal_offer.debtor_ids, _sanitize_amounts(formal_offer.debtor_amounts)):
+        if not is_valid_amount:
             return failure(error_code='PAY003', message='Invalid amount.')
         _make_payment_order(
             formal_offer,
@@ -218,6 +525,73 @@ def process_prepared_payment_transfer_signal(
     ))
 
 
+@atomic
+def abort_stale_payment_orders(cutoff_ts: datetime, max_count: int) -> int:
+    stale_payment_orders = PaymentOrder.query.filter(
+        PaymentOrder.finalized_at_ts.is_(None),
+        PaymentOrder.created_at_ts <= cutoff_ts,
+    ).order_by(PaymentOrder.created_at_ts).limit(max_count).with_for_update(skip_locked=True).all()
+    for payment_order in stale_payment_orders:
+        _abort_payment_order(
+            payment_order,
+            abort_reason={'error_code': 'PAY007', 'message': 'The payment order has timed out.'},
+        )
+    return len(stale_payment_orders)
+
+
+@atomic
+def resend_stale_prepare_transfer_signals(
+        created_after_ts: datetime,
+        created_before_ts: datetime,
+        max_count: int,
+        prev: Optional[Tuple[datetime, int, int]] = None) -> Optional[Tuple[datetime, int, int]]:
+    """Re-send the pending prepare transfer signals for up to `max_count` stale orders.
+
+    The orders are ordered by `(created_at_ts, payee_creditor_id,
+    payment_coordinator_request_id)`, which is unique. If there might
+    be more orders to process, the key of the last processed order is
+    returned, so that it can be passed as `prev` in the next call.
+
+    """
+
+    sort_key = tuple_(
+        PaymentOrder.created_at_ts,
+        PaymentOrder.payee_creditor_id,
+        PaymentOrder.payment_coordinator_request_id,
+    )
+
+    # Orders whose signals are still waiting to be sent are skipped.
+    pending_signal_exists = exists().where(and_(
+        PrepareTransferSignal.payee_creditor_id == PaymentOrder.payee_creditor_id,
+        PrepareTransferSignal.coordinator_request_id.in_([
+            PaymentOrder.payment_coordinator_request_id,
+            -PaymentOrder.payment_coordinator_request_id,
+        ]),
+    ))
+    query = PaymentOrder.query.filter(
+        PaymentOrder.finalized_at_ts.is_(None),
+        PaymentOrder.created_at_ts > created_after_ts,
+        PaymentOrder.created_at_ts <= created_before_ts,
+        ~pending_signal_exists,
+    )
+    if prev is not None:
+        query = query.filter(sort_key > tuple_(*prev))
+    stale_payment_orders = query.order_by(*sort_key.clauses).limit(max_count).with_for_update(skip_locked=True).all()
+    for payment_order in stale_payment_orders:
+        # The re-sent signal has the same `coordinator_request_id` as
+        # the original one. Therefore, if the original signal has
+        # been processed after all, the second prepared transfer will
+        # be dismissed by `process_prepared_payment_transfer_signal()`.
+        signal = _create_prepare_transfer_signal(payment_order)
+        if signal:
+            db.session.add(signal)
+
+    if len(stale_payment_orders) < max_count:
+        return None
+    last = stale_payment_orders[-1]
+    return last.created_at_ts, last.payee_creditor_id, last.payment_coordinator_request_id
+
+
 @atomic
 def flush_payment_orders(cutoff_ts: datetime) -> int:
     return PaymentOrder.query.filter(PaymentOrder.finalized_at_ts <= cutoff_ts).delete()
@@ -225,7 +599,91 @@ def flush_payment_orders(cutoff_ts: datetime) -> int:
 
 @atomic
 def flush_payment_proofs(cutoff_ts: datetime) -> int:
-    return PaymentProof.query.filter(PaymentProof.paid_at_ts <= cutoff_ts).delete()
+    deleted_proofs = db.session.execute(
+        PaymentProof.__table__.delete().where(
+            PaymentProof.paid_at_ts <= cutoff_ts,
+        ).returning(PaymentProof.offer_description_hash)
+    ).fetchall()
+    _delete_unreferenced_descriptions([row.offer_description_hash for row in deleted_proofs])
+    return len(deleted_proofs)
+
+
+@atomic
+def flush_signals(signal_model: Type[Signal], cutoff_ts: datetime, max_count: int) -> int:
+    # Signals that are being sent by other workers at the moment are
+    # skipped. This allows many workers to flush the same table in
+    # parallel.
+    signals = signal_model.query.filter(
+        signal_model.inserted_at_ts < cutoff_ts,
+    ).order_by(
+        *getattr(signal_model, 'signalbus_order_by', ()),
+    ).limit(max_count).with_for_update(skip_locked=True).all()
+    if signals:
+        signal_model.send_signalbus_messages(signals)
+        for signal in signals:
+            db.session.delete(signal)
+    return len(signals)
+
+
+@lru_cache(maxsize=DESCRIPTION_CACHE_SIZE)
+@atomic
+def _get_description(description_hash: bytes) -> Optional[dict]:
+    return db.session.query(DescriptionBlob.description).filter_by(description_hash=description_hash).scalar()
+
+
+def _get_json_size(obj) -> int:
+    return len(json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf8'))
+
+
+def _get_next_id(model: Type[db.Model], sequence_name: str) -> int:
+    # The ID is obtained before the row gets inserted, so that
+    # everything that depends on it can be written with the row.
+    bind = db.session.get_bind(model.__mapper__)
+    return db.session.execute(select([func.nextval(sequence_name)]), bind=bind).scalar()
+
+
+def _calc_description_hash(description: dict) -> bytes:
+    s = json.dumps(description, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(s.encode('utf8')).digest()
+
+
+def _store_description(description: Optional[dict]) -> Optional[bytes]:
+    if description is None:
+        return None
+
+    description_hash = _calc_description_hash(description)
+    db.session.execute(pg_insert(DescriptionBlob.__table__).values(
+        description_hash=description_hash,
+        description=description,
+    ).on_conflict_do_nothing())
+
+    # We obtain a "key share" lock on the stored description, so that
+    # it can not be deleted by `_delete_unreferenced_descriptions()`
+    # before the referring row has been inserted.
+    db.session.query(DescriptionBlob.description_hash).filter_by(
+        description_hash=description_hash,
+    ).with_for_update(read=True, key_share=True).scalar()
+    return description_hash
+
+
+def _delete_unreferenced_descriptions(description_hashes: Iterable[Optional[bytes]]) -> int:
+    # Only the descriptions referred to by the just deleted rows are
+    # checked, so that we do not need to scan the whole table.
+    # Descriptions that are locked at the moment are skipped, because
+    # they are probably about to be referred to.
+    description_hashes = list({bytes(h) for h in description_hashes if h is not None})
+    if not description_hashes:
+        return 0
+
+    db.session.flush()
+    unreferenced_descriptions = select([DescriptionBlob.description_hash]).where(and_(
+        DescriptionBlob.description_hash.in_(description_hashes),
+        ~exists().where(FormalOffer.description_hash == DescriptionBlob.description_hash),
+        ~exists().where(PaymentProof.offer_description_hash == DescriptionBlob.description_hash),
+    )).with_for_update(skip_locked=True)
+    return DescriptionBlob.query.filter(
+        DescriptionBlob.description_hash.in_(unreferenced_descriptions),
+    ).delete(synchronize_session=False)
 
 
 def _make_payment_order(
@@ -259,6 +717,76 @@ def _make_payment_order(
         _try_to_finalize_payment_order(payment_order)
 
 
+def _cancel_formal_offer(fo: FormalOffer) -> None:
+    _abort_unfinalized_payment_orders(fo)
+    db.session.add(CanceledFormalOfferSignal(
+        payee_creditor_id=fo.payee_creditor_id,
+        offer_id=fo.offer_id,
+    ))
+    db.session.delete(fo)
+
+
+def _insert_payment_order(
+        payee_creditor_id: int,
+        offer_id: int,
+        offer_secret: bytes,
+        payer_creditor_id: int,
+        payer_payment_order_seqnum: int,
+        debtor_id: int,
+        amount: int,
+        proof_secret: bytes,
+        payer_note: dict) -> Optional[PaymentOrder]:
+    # Inserts a new payment order, but only if the offer exists, has
+    # not expired, the payment option is valid, and the payment order
+    # has not been created already. Note that we obtain a shared lock
+    # on the offer record, exactly as `_make_payment_order()` does.
+    current_ts = datetime.now(tz=timezone.utc)
+    payment_order_table = PaymentOrder.__table__
+    formal_offer_query = select([
+        FormalOffer.payee_creditor_id,
+        FormalOffer.offer_id,
+        literal(payer_creditor_id, db.BigInteger),
+        literal(payer_payment_order_seqnum, db.Integer),
+        literal(debtor_id, db.BigInteger),
+        literal(amount, db.BigInteger),
+        FormalOffer.reciprocal_payment_debtor_id,
+        FormalOffer.reciprocal_payment_amount,
+        literal(payer_note, payment_order_table.c.payer_note.type),
+        literal(proof_secret, payment_order_table.c.proof_secret.type),
+        literal(current_ts, payment_order_table.c.created_at_ts.type),
+    ]).where(and_(
+        FormalOffer.payee_creditor_id == payee_creditor_id,
+        FormalOffer.offer_id == offer_id,
+        FormalOffer.offer_secret == offer_secret,
+        FormalOffer.valid_until_ts >= current_ts,
+        _payment_option_exists(debtor_id, amount),
+    )).with_for_update(read=True)
+    insert_stmt = pg_insert(payment_order_table).from_select([
+        'payee_creditor_id',
+        'offer_id',
+        'payer_creditor_id',
+        'payer_payment_order_seqnum',
+        'debtor_id',
+        'amount',
+        'reciprocal_payment_debtor_id',
+        'reciprocal_payment_amount',
+        'payer_note',
+        'proof_secret',
+        'created_at_ts',
+    ], formal_offer_query).on_conflict_do_nothing().returning(*payment_order_table.c)
+
+    row = db.session.execute(insert_stmt).fetchone()
+    if row is None:
+        return None
+
+    # Make the ORM aware of the newly inserted row, without issuing
+    # another query.
+    payment_order = PaymentOrder(**dict(row))
+    make_transient_to_detached(payment_order)
+    db.session.add(payment_order)
+    return payment_order
+
+
 def _abort_unfinalized_payment_orders(fo: FormalOffer) -> None:
     unfinalized_payment_orders = PaymentOrder.query.filter_by(
         payee_creditor_id=fo.payee_creditor_id,
@@ -326,7 +854,7 @@ def _execute_payment_order(po: PaymentOrder) -> None:
     formal_offer = FormalOffer.query.filter_by(
         payee_creditor_id=po.payee_creditor_id,
         offer_id=po.offer_id,
-    ).with_for_update().one()
+    ).options(defer(FormalOffer.document)).with_for_update().one()
 
     # Frist: Finalize all payment orders.
     if po.payment_transfer_id is not None:
@@ -353,6 +881,7 @@ def _execute_payment_order(po: PaymentOrder) -> None:
     # Second: Generate a payment proof.
     payment_proof = PaymentProof(
         payee_creditor_id=po.payee_creditor_id,
+        proof_id=_get_next_id(PaymentProof, 'payment_proof_proof_id_seq'),
         proof_secret=proof_secret,
         payer_creditor_id=po.payer_creditor_id,
         debtor_id=po.debtor_id,
@@ -363,10 +892,11 @@ def _execute_payment_order(po: PaymentOrder) -> None:
         reciprocal_payment_amount=po.reciprocal_payment_amount,
         offer_id=po.offer_id,
         offer_created_at_ts=formal_offer.created_at_ts,
-        offer_description=formal_offer.description,
+        offer_description_hash=formal_offer.description_hash,
     )
+    payment_proof.document, payment_proof.document_etag = render_proof(payment_proof)
     db.session.add(payment_proof)
-    db.session.flush()
+    _missing_payment_proofs.discard((payment_proof.payee_creditor_id, payment_proof.proof_id))
 
     # Third: Send successful payment signal and delete the offer.
     db.session.add(SuccessfulPaymentSignal(
@@ -388,10 +918,18 @@ def _execute_payment_order(po: PaymentOrder) -> None:
 def _try_to_finalize_payment_order(po: PaymentOrder) -> None:
     assert po.finalized_at_ts is None
 
+    prepare_transfer_signal = _create_prepare_transfer_signal(po)
+    if prepare_transfer_signal:
+        db.session.add(prepare_transfer_signal)
+    else:
+        _execute_payment_order(po)
+
+
+def _create_prepare_transfer_signal(po: PaymentOrder) -> Optional[PrepareTransferSignal]:
     should_prepare_transfer = po.payment_transfer_id is None and po.amount > 0
     should_prepare_reciprocal_transfer = po.reciprocal_payment_transfer_id is None and po.reciprocal_payment_amount > 0
     if should_prepare_transfer:
-        db.session.add(PrepareTransferSignal(
+        return PrepareTransferSignal(
             payee_creditor_id=po.payee_creditor_id,
             coordinator_request_id=po.payment_coordinator_request_id,
             min_amount=po.amount,
@@ -399,9 +937,9 @@ def _try_to_finalize_payment_order(po: PaymentOrder) -> None:
             debtor_id=po.debtor_id,
             sender_creditor_id=po.payer_creditor_id,
             recipient_creditor_id=po.payee_creditor_id,
-        ))
-    elif should_prepare_reciprocal_transfer:
-        db.session.add(PrepareTransferSignal(
+        )
+    if should_prepare_reciprocal_transfer:
+        return PrepareTransferSignal(
             payee_creditor_id=po.payee_creditor_id,
             coordinator_request_id=-po.payment_coordinator_request_id,
             min_amount=po.reciprocal_payment_amount,
@@ -409,13 +947,24 @@ def _try_to_finalize_payment_order(po: PaymentOrder) -> None:
             debtor_id=po.reciprocal_payment_debtor_id,
             sender_creditor_id=po.payee_creditor_id,
             recipient_creditor_id=po.payer_creditor_id,
+        )
+    return None
+
+
+def _payment_option_exists(debtor_id: int, amount: int):
+    # Generates an SQL expression which is TRUE if the given pair of
+    # `debtor_id` and `amount` is one of the payment options of the
+    # formal offer. Note that `NULL` and negative amounts should be
+    # handled as if they were zeros.
+    i = literal_column('i')
+    return exists(
+        select([literal_column('1')])
+        .select_from(func.generate_subscripts(FormalOffer.debtor_ids, 1).alias('i'))
+        .where(and_(
+            FormalOffer.debtor_ids[i] == debtor_id,
+            func.greatest(func.coalesce(FormalOffer.debtor_amounts[i], 0), 0) == amount,
         ))
-    else:
-        _execute_payment_order(po)
-
-
-def _sanitize_amounts(amounts: List[Optional[int]]) -> List[int]:
-    return [(x if (x is not None and x >= 0) else 0) for x in amounts]
+    )
 
 
 def _find_payment_order(coordinator_id: int, coordinator_request_id: int) -> Tuple[Optional[PaymentOrder], bool]:
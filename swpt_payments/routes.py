@@ -1,105 +1,34 @@
+import os
+import json
+import zlib
 import binascii
-from base64 import urlsafe_b64decode, urlsafe_b64encode
-from marshmallow import fields, Schema
-from marshmallow.utils import missing
-from flask import Blueprint, abort
+import iso8601
+from datetime import datetime
+from base64 import urlsafe_b64decode
+from functools import lru_cache
+from typing import Optional, Iterable, Iterator, Callable, TypeVar, List, Tuple
+from urllib.parse import urlencode
+from flask import Blueprint, Response, abort, request, stream_with_context
 from flask.views import MethodView
+from .schemas import OFFER_PATH, OFFER_LIST_PATH, PROOF_PATH, PROOF_LIST_PATH, PAYER_PROOF_LIST_PATH, \
+    CONTEXT_PATH, context_documents, render_offer, render_proof, inline_context, serialize_description, \
+    add_description
+from .models import FormalOffer, PaymentProof, MIN_INT64, MAX_INT64
 from . import procedures
 
-DEBTOR_PATH = '/debtors/{}'
-CREDITOR_PATH = '/creditors/{}'
-CONTEXT_PATH = '/contexts/{}'
-OFFER_PATH = '/formal-offers/{}/{}/{}'
-PROOF_PATH = '/payment-proofs/{}/{}/{}'
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
 
+COMPRESSION_CACHE_SIZE = int(os.environ.get('APP_COMPRESSION_CACHE_SIZE', '1000'))
+MIN_COMPRESSED_SIZE = 256
+CONTENT_ENCODINGS = ['br', 'gzip'] if brotli else ['gzip']
+CREDITOR_ID_HEADER = os.environ.get('APP_CREDITOR_ID_HEADER', '')
+MAX_PAGE_SIZE = 100
 
-def _get_debtor_url(debtor_id):
-    return DEBTOR_PATH.format(debtor_id)
+T = TypeVar('T')
 
-
-def _get_creditor_url(creditor_id):
-    return CREDITOR_PATH.format(creditor_id)
-
-
-class JsonLdMixin:
-    _id = fields.Method('get_id', data_key='@id')
-    _type = fields.Method('get_type', data_key='@type')
-    _context = fields.Method('get_context', data_key='@context')
-
-    def get_type(self, obj):
-        return type(obj).__name__
-
-    def get_context(self, obj):
-        filename = self.get_type(obj) + '.jsonld'
-        return CONTEXT_PATH.format(filename)
-
-
-class OfferSchema(Schema, JsonLdMixin):
-    offer_id = fields.Int(data_key='offerId')
-    created_at_ts = fields.DateTime(data_key='offerCreatedAt')
-    valid_until_ts = fields.DateTime(data_key='offerValidUntil')
-    description = fields.Raw(data_key='offerDescription')
-    payee = fields.Function(lambda obj: _get_creditor_url(obj.payee_creditor_id))
-    paymentOptions = fields.Method('get_payment_options')
-    reciprocalPayment = fields.Method('get_reciprocal_payment')
-
-    def get_id(self, obj):
-        return OFFER_PATH.format(
-            obj.payee_creditor_id,
-            obj.offer_id,
-            urlsafe_b64encode(obj.offer_secret).decode(),
-        )
-
-    def get_payment_options(self, obj):
-        return [{
-            '@type': 'PaymentDescription',
-            'via': _get_debtor_url(debtor_id),
-            'amount': amount or 0,
-        } for debtor_id, amount in zip(obj.debtor_ids, obj.debtor_amounts) if debtor_id is not None]
-
-    def get_reciprocal_payment(self, obj):
-        if obj.reciprocal_payment_debtor_id is None:
-            return missing
-        else:
-            return {
-                '@type': 'PaymentDescription',
-                'via': _get_debtor_url(obj.reciprocal_payment_debtor_id),
-                'amount': obj.reciprocal_payment_amount,
-            }
-
-
-class ProofSchema(Schema, JsonLdMixin):
-    amount = fields.Int(data_key='paidAmount')
-    paid_at_ts = fields.DateTime(data_key='paidAt')
-    payer_note = fields.Raw(data_key='payerNote')
-    offer_id = fields.Int(data_key='offerId')
-    offer_description = fields.Raw(data_key='offerDescription')
-    offer_created_at_ts = fields.DateTime(data_key='offerCreatedAt')
-    paidVia = fields.Function(lambda obj: _get_debtor_url(obj.debtor_id))
-    payee = fields.Function(lambda obj: _get_creditor_url(obj.payee_creditor_id))
-    payer = fields.Function(lambda obj: _get_creditor_url(obj.payer_creditor_id))
-    reciprocalPayment = fields.Method('get_reciprocal_payment')
-
-    def get_id(self, obj):
-        return PROOF_PATH.format(
-            obj.payee_creditor_id,
-            obj.proof_id,
-            urlsafe_b64encode(obj.proof_secret).decode(),
-        )
-
-    def get_reciprocal_payment(self, obj):
-        if obj.reciprocal_payment_debtor_id is None:
-            return missing
-        else:
-            return {
-                '@type': 'PaymentDescription',
-                'via': _get_debtor_url(obj.reciprocal_payment_debtor_id),
-                'amount': obj.reciprocal_payment_amount,
-            }
-
-
-offer_schema = OfferSchema()
-proof_schema = ProofSchema()
 web_api = Blueprint('web_api', __name__)
 
 
@@ -110,10 +39,7 @@ class OfferAPI(MethodView):
             urlsafe_b64decode(offer_secret) == offer.offer_secret or abort(404)
         except binascii.Error:
             abort(404)
-        return offer_schema.dumps(offer), 200, {
-            'Content-Type': 'application/ld+json',
-            'Cache-Control': 'public, max-age=31536000',
-        }
+        return _make_document_response(*_get_offer_document(offer), allow_inline_context=True)
 
 
 class ProofAPI(MethodView):
@@ -123,10 +49,232 @@ class ProofAPI(MethodView):
             urlsafe_b64decode(proof_secret) == proof.proof_secret or abort(404)
         except binascii.Error:
             abort(404)
-        return proof_schema.dumps(proof), 200, {
-            'Content-Type': 'application/ld+json',
-            'Cache-Control': 'public, max-age=31536000',
-        }
+        return _make_document_response(*_get_proof_document(proof), allow_inline_context=True)
+
+
+class OfferListAPI(MethodView):
+    def get(self, payee_creditor_id):
+        _ensure_authenticated(payee_creditor_id)
+        max_count = _get_page_size()
+        offers = procedures.get_payee_formal_offers(
+            payee_creditor_id,
+            max_count,
+            prev_offer_id=_get_query_arg('prev', _parse_int64),
+            min_valid_until_ts=_get_query_arg('minValidUntil', _parse_datetime),
+            max_valid_until_ts=_get_query_arg('maxValidUntil', _parse_datetime),
+        )
+        next_page_url = _get_next_page_url(prev=offers[-1].offer_id) if len(offers) == max_count else None
+        return _make_page_response(_iter_offer_documents(offers), next_page_url)
+
+
+class ProofListAPI(MethodView):
+    def get(self, payee_creditor_id):
+        _ensure_authenticated(payee_creditor_id)
+        max_count = _get_page_size()
+        prev_proof_id = _get_query_arg('prev', _parse_int64)
+        prev_paid_at_ts = _get_query_arg('prevPaidAt', _parse_datetime)
+        if (prev_proof_id is None) != (prev_paid_at_ts is None):
+            abort(400)
+        proofs = procedures.get_payee_payment_proofs(
+            payee_creditor_id,
+            max_count,
+            prev=None if prev_proof_id is None else (prev_paid_at_ts, prev_proof_id),
+            min_paid_at_ts=_get_query_arg('minPaidAt', _parse_datetime),
+            max_paid_at_ts=_get_query_arg('maxPaidAt', _parse_datetime),
+        )
+        next_page_url = None
+        if len(proofs) == max_count:
+            last_proof = proofs[-1]
+            next_page_url = _get_next_page_url(prev=last_proof.proof_id, prevPaidAt=last_proof.paid_at_ts.isoformat())
+        return _make_page_response(_iter_proof_documents(proofs), next_page_url)
+
+
+class PayerProofListAPI(MethodView):
+    def get(self, payer_creditor_id):
+        _ensure_authenticated(payer_creditor_id)
+        max_count = _get_page_size()
+        proofs = procedures.get_payer_payment_proofs(
+            payer_creditor_id,
+            max_count,
+            prev_proof_id=_get_query_arg('prev', _parse_int64),
+        )
+        next_page_url = _get_next_page_url(prev=proofs[-1].proof_id) if len(proofs) == max_count else None
+        return _make_page_response(_iter_proof_documents(proofs), next_page_url)
+
+
+class ContextAPI(MethodView):
+    def get(self, filename):
+        context_document = context_documents.get(filename) or abort(404)
+        return _make_document_response(context_document.document, context_document.etag)
+
+
+def _make_document_response(document: bytes, etag: str, allow_inline_context: bool = False) -> Response:
+    # Offers, proofs, and contexts never change, so their documents
+    # can be cached forever.
+    if allow_inline_context and request.args.get('inlineContext') == 'true':
+        document = _inline_context(document)
+        etag = f'{etag}-inline'
+
+    content_encoding = _choose_content_encoding(document)
+    if content_encoding:
+        document = _compress(document, content_encoding)
+        etag = f'{etag}-{content_encoding}'
+
+    response = Response(document, content_type='application/ld+json')
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    if content_encoding:
+        response.headers['Content-Encoding'] = content_encoding
+    response.vary.add('Accept-Encoding')
+    response.set_etag(etag)
+    return response.make_conditional(request)
+
+
+def _choose_content_encoding(document: bytes) -> Optional[str]:
+    if len(document) < MIN_COMPRESSED_SIZE:
+        return None
+    return request.accept_encodings.best_match(CONTENT_ENCODINGS)
+
+
+def _make_page_response(documents: Iterable[bytes], next_page_url: Optional[str]) -> Response:
+    # The page is streamed, so that the documents do not need to be
+    # copied into one big string.
+    chunks = stream_with_context(_iter_page(documents, next_page_url))
+    content_encoding = request.accept_encodings.best_match(CONTENT_ENCODINGS)
+    if content_encoding:
+        chunks = _iter_compressed(chunks, content_encoding)
+
+    response = Response(chunks, content_type='application/json')
+    response.headers['Cache-Control'] = 'private, no-cache'
+    if content_encoding:
+        response.headers['Content-Encoding'] = content_encoding
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def _iter_page(documents: Iterable[bytes], next_page_url: Optional[str]) -> Iterator[bytes]:
+    yield b'{"items": ['
+    for n, document in enumerate(documents):
+        if n > 0:
+            yield b', '
+        yield document
+    yield b']'
+    if next_page_url is not None:
+        yield b', "next": ' + json.dumps(next_page_url).encode('utf8')
+    yield b'}'
+
+
+def _iter_offer_documents(offers: List[FormalOffer]) -> Iterator[bytes]:
+    for offer in offers:
+        yield _get_offer_document(offer)[0]
+
+
+def _iter_proof_documents(proofs: List[PaymentProof]) -> Iterator[bytes]:
+    # Proofs created before their documents were stored are rendered
+    # one by one, while the page is being sent.
+    for proof in proofs:
+        yield _get_proof_document(proof)[0]
+
+
+def _get_offer_document(offer: FormalOffer) -> Tuple[bytes, str]:
+    if offer.document is None:
+        document, etag = render_offer(offer)
+    else:
+        document, etag = bytes(offer.document), offer.document_etag
+    return add_description(document, _get_serialized_description(offer.description_hash)), etag
+
+
+def _get_proof_document(proof: PaymentProof) -> Tuple[bytes, str]:
+    if proof.document is None:
+        document, etag = render_proof(proof)
+    else:
+        document, etag = bytes(proof.document), proof.document_etag
+    return add_description(document, _get_serialized_description(proof.offer_description_hash)), etag
+
+
+def _get_serialized_description(description_hash: Optional[bytes]) -> bytes:
+    return _serialize_description(None if description_hash is None else bytes(description_hash))
+
+
+def _iter_compressed(chunks: Iterable[bytes], content_encoding: str) -> Iterator[bytes]:
+    if content_encoding == 'br':
+        compressor = brotli.Compressor(mode=brotli.MODE_TEXT)
+        compress, flush = compressor.process, compressor.finish
+    else:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # gzip format
+        compress, flush = compressor.compress, compressor.flush
+    for chunk in chunks:
+        compressed_chunk = compress(chunk)
+        if compressed_chunk:
+            yield compressed_chunk
+    yield flush()
+
+
+def _ensure_authenticated(creditor_id: int) -> None:
+    # The authentication is performed by a reverse proxy, which
+    # passes the ID of the authenticated creditor in the
+    # `APP_CREDITOR_ID_HEADER` header. The proxy must remove this
+    # header from the incoming requests.
+    authenticated_creditor_id = request.headers.get(CREDITOR_ID_HEADER)
+    if authenticated_creditor_id is None:
+        abort(401)
+    if authenticated_creditor_id != str(creditor_id):
+        abort(403)
+
+
+def _get_page_size() -> int:
+    page_size = _get_query_arg('limit', int) or MAX_PAGE_SIZE
+    return max(1, min(page_size, MAX_PAGE_SIZE))
+
+
+def _get_query_arg(name: str, parse: Callable[[str], T]) -> Optional[T]:
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        return parse(value)
+    except ValueError:
+        abort(400)
+
+
+def _get_next_page_url(**cursor) -> str:
+    args = request.args.to_dict()
+    args.update((name, str(value)) for name, value in cursor.items())
+    return f'{request.path}?{urlencode(args)}'
+
+
+def _parse_int64(value: str) -> int:
+    n = int(value)
+    if not MIN_INT64 <= n <= MAX_INT64:
+        raise ValueError(value)
+    return n
+
+
+def _parse_datetime(value: str) -> datetime:
+    # Older versions of `iso8601` raise a `ParseError` which is not a
+    # subclass of `ValueError`.
+    try:
+        return iso8601.parse_date(value)
+    except iso8601.ParseError:
+        raise ValueError(value) from None
+
+
+@lru_cache(maxsize=procedures.DESCRIPTION_CACHE_SIZE)
+def _serialize_description(description_hash: Optional[bytes]) -> bytes:
+    return serialize_description(procedures.get_description(description_hash))
+
+
+@lru_cache(maxsize=COMPRESSION_CACHE_SIZE)
+def _inline_context(document: bytes) -> bytes:
+    return inline_context(document)
+
+
+@lru_cache(maxsize=COMPRESSION_CACHE_SIZE)
+def _compress(document: bytes, content_encoding: str) -> bytes:
+    # Documents never change, so each one is compressed only once.
+    if content_encoding == 'br':
+        return brotli.compress(document, mode=brotli.MODE_TEXT)
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # gzip format
+    return compressor.compress(document) + compressor.flush()
 
 
 # TODO: Add JSON-LD signature to the payment proof.
@@ -148,3 +296,22 @@ web_api.add_url_rule(
     PROOF_PATH.format('<int:payee_creditor_id>', '<int:proof_id>', '<proof_secret>'),
     view_func=ProofAPI.as_view('show_proof'),
 )
+if CREDITOR_ID_HEADER:
+    # The lists are available only when an authenticating reverse
+    # proxy has been configured (see `_ensure_authenticated()`).
+    web_api.add_url_rule(
+        OFFER_LIST_PATH.format('<int:payee_creditor_id>'),
+        view_func=OfferListAPI.as_view('list_offers'),
+    )
+    web_api.add_url_rule(
+        PROOF_LIST_PATH.format('<int:payee_creditor_id>'),
+        view_func=ProofListAPI.as_view('list_proofs'),
+    )
+    web_api.add_url_rule(
+        PAYER_PROOF_LIST_PATH.format('<int:payer_creditor_id>'),
+        view_func=PayerProofListAPI.as_view('list_payer_proofs'),
+    )
+web_api.add_url_rule(
+    CONTEXT_PATH.format('<filename>'),
+    view_func=ContextAPI.as_view('show_context'),
+)
@@ -0,0 +1,182 @@
+import os
+import json
+import hashlib
+from base64 import urlsafe_b64encode
+from typing import Optional, Tuple, Dict, NamedTuple
+from marshmallow import fields, Schema
+from marshmallow.utils import missing
+from .models import FormalOffer, PaymentProof
+
+DEBTOR_PATH = '/debtors/{}'
+CREDITOR_PATH = '/creditors/{}'
+CONTEXT_PATH = '/contexts/{}'
+OFFER_PATH = '/formal-offers/{}/{}/{}'
+OFFER_LIST_PATH = '/formal-offers/{}/'
+PROOF_PATH = '/payment-proofs/{}/{}/{}'
+PROOF_LIST_PATH = '/payment-proofs/{}/'
+PAYER_PROOF_LIST_PATH = '/payer-payment-proofs/{}/'
+CONTEXTS_DIR = os.path.join(os.path.dirname(__file__), 'contexts')
+
+
+class ContextDocument(NamedTuple):
+    context: dict
+    document: bytes
+    etag: str
+
+
+def _get_debtor_url(debtor_id):
+    return DEBTOR_PATH.format(debtor_id)
+
+
+def _get_creditor_url(creditor_id):
+    return CREDITOR_PATH.format(creditor_id)
+
+
+class JsonLdMixin:
+    _id = fields.Method('get_id', data_key='@id')
+    _type = fields.Method('get_type', data_key='@type')
+    _context = fields.Method('get_context', data_key='@context')
+
+    def get_type(self, obj):
+        return type(obj).__name__
+
+    def get_context(self, obj):
+        filename = self.get_type(obj) + '.jsonld'
+        return CONTEXT_PATH.format(filename)
+
+
+class OfferSchema(Schema, JsonLdMixin):
+    offer_id = fields.Int(data_key='offerId')
+    created_at_ts = fields.DateTime(data_key='offerCreatedAt')
+    valid_until_ts = fields.DateTime(data_key='offerValidUntil')
+    payee = fields.Function(lambda obj: _get_creditor_url(obj.payee_creditor_id))
+    paymentOptions = fields.Method('get_payment_options')
+    reciprocalPayment = fields.Method('get_reciprocal_payment')
+
+    def get_id(self, obj):
+        return OFFER_PATH.format(
+            obj.payee_creditor_id,
+            obj.offer_id,
+            urlsafe_b64encode(obj.offer_secret).decode(),
+        )
+
+    def get_payment_options(self, obj):
+        return [{
+            '@type': 'PaymentDescription',
+            'via': _get_debtor_url(debtor_id),
+            'amount': amount or 0,
+        } for debtor_id, amount in zip(obj.debtor_ids, obj.debtor_amounts) if debtor_id is not None]
+
+    def get_reciprocal_payment(self, obj):
+        if obj.reciprocal_payment_debtor_id is None:
+            return missing
+        else:
+            return {
+                '@type': 'PaymentDescription',
+                'via': _get_debtor_url(obj.reciprocal_payment_debtor_id),
+                'amount': obj.reciprocal_payment_amount,
+            }
+
+
+class ProofSchema(Schema, JsonLdMixin):
+    amount = fields.Int(data_key='paidAmount')
+    paid_at_ts = fields.DateTime(data_key='paidAt')
+    payer_note = fields.Raw(data_key='payerNote')
+    offer_id = fields.Int(data_key='offerId')
+    offer_created_at_ts = fields.DateTime(data_key='offerCreatedAt')
+    paidVia = fields.Function(lambda obj: _get_debtor_url(obj.debtor_id))
+    payee = fields.Function(lambda obj: _get_creditor_url(obj.payee_creditor_id))
+    payer = fields.Function(lambda obj: _get_creditor_url(obj.payer_creditor_id))
+    reciprocalPayment = fields.Method('get_reciprocal_payment')
+
+    def get_id(self, obj):
+        return PROOF_PATH.format(
+            obj.payee_creditor_id,
+            obj.proof_id,
+            urlsafe_b64encode(obj.proof_secret).decode(),
+        )
+
+    def get_reciprocal_payment(self, obj):
+        if obj.reciprocal_payment_debtor_id is None:
+            return missing
+        else:
+            return {
+                '@type': 'PaymentDescription',
+                'via': _get_debtor_url(obj.reciprocal_payment_debtor_id),
+                'amount': obj.reciprocal_payment_amount,
+            }
+
+
+def render_offer(offer: FormalOffer) -> Tuple[bytes, str]:
+    """Return the offer's JSON-LD document without the description, and
+    its entity tag.
+
+    The description is added with `add_description()`. Because the
+    description of an offer never changes, the entity tag identifies
+    the complete document too.
+
+    """
+
+    return _render(OfferSchema(), offer)
+
+
+def render_proof(proof: PaymentProof) -> Tuple[bytes, str]:
+    """Return the proof's JSON-LD document without the offer description,
+    and its entity tag.
+
+    The description is added with `add_description()`.
+
+    """
+
+    return _render(ProofSchema(), proof)
+
+
+def serialize_description(description: Optional[dict]) -> bytes:
+    return json.dumps(description).encode('utf8')
+
+
+def add_description(document: bytes, serialized_description: bytes) -> bytes:
+    """Add the `offerDescription` property to a rendered offer or proof.
+
+    The descriptions are shared between many offers and proofs, and
+    therefore they are not stored in the rendered documents. The
+    property is added at the end of the JSON object, so that the
+    document does not need to be parsed.
+
+    """
+
+    assert document.endswith(b'}')
+    return b'%s, "offerDescription": %s}' % (document[:-1], serialized_description)
+
+
+def inline_context(document: bytes) -> bytes:
+    """Replace the `@context` reference in a rendered document with the context itself."""
+
+    data = json.loads(document)
+    context_filename = os.path.basename(data['@context'])
+    data['@context'] = context_documents[context_filename].context
+    return json.dumps(data).encode('utf8')
+
+
+def _render(schema: Schema, obj) -> Tuple[bytes, str]:
+    document = schema.dumps(obj).encode('utf8')
+    return document, _calc_etag(document)
+
+
+def _calc_etag(document: bytes) -> str:
+    return hashlib.blake2b(document, digest_size=16).hexdigest()
+
+
+def _load_context_documents() -> Dict[str, ContextDocument]:
+    context_documents = {}
+    for filename in os.listdir(CONTEXTS_DIR):
+        if filename.endswith('.jsonld'):
+            with open(os.path.join(CONTEXTS_DIR, filename), 'rb') as f:
+                context = json.load(f)['@context']
+            document = json.dumps({'@context': context}, separators=(',', ':')).encode('utf8')
+            context_documents[filename] = ContextDocument(context, document, _calc_etag(document))
+    return context_documents
+
+
+# The context documents are loaded and serialized only once.
+context_documents = _load_context_documents()
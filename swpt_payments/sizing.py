@@ -0,0 +1,69 @@
+"""Derive the worker concurrency and the database pool size.
+
+Every dramatiq worker thread (or greenlet) holds a database connection
+while it processes a message, so the total number of worker threads
+must fit in the database connections budget
+(APP_MAX_DB_CONNECTIONS). The number of worker processes is derived
+from the number of available CPUs, and the budget is split evenly
+between the processes. Settings that are explicitly given in the
+environment are left as they are.
+
+Running ``python -m swpt_payments.sizing`` prints the derived settings
+as shell variable assignments, suitable for ``eval``. When the
+``--gevent`` flag is given, DRAMATIQ_GREENLETS is derived instead of
+DRAMATIQ_THREADS.
+
+"""
+
+import os
+import sys
+from typing import Mapping, Optional, Dict
+
+DEFAULT_MAX_DB_CONNECTIONS = 100
+DEFAULT_MAX_THREADS_PER_PROCESS = 8
+DEFAULT_MAX_GREENLETS_PER_PROCESS = 64
+PREFETCH_PER_THREAD = 2
+
+
+def get_cpu_count() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # pragma: no cover
+        return os.cpu_count() or 1
+
+
+def calc_sizing(environ: Mapping[str, str], cpu_count: int, gevent: bool = False) -> Dict[str, int]:
+    if gevent:
+        threads_name, max_threads = 'DRAMATIQ_GREENLETS', DEFAULT_MAX_GREENLETS_PER_PROCESS
+    else:
+        threads_name, max_threads = 'DRAMATIQ_THREADS', DEFAULT_MAX_THREADS_PER_PROCESS
+    max_connections = _get_int(environ, 'APP_MAX_DB_CONNECTIONS') or DEFAULT_MAX_DB_CONNECTIONS
+    processes = _get_int(environ, 'DRAMATIQ_PROCESSES') or max(1, min(cpu_count, max_connections))
+    connections_per_process = max(1, max_connections // processes)
+    threads = _get_int(environ, threads_name) or min(connections_per_process, max_threads)
+    pool_size = _get_int(environ, 'SQLALCHEMY_POOL_SIZE') or threads
+    max_overflow = _get_int(environ, 'SQLALCHEMY_MAX_OVERFLOW')
+    if max_overflow is None:
+        # The connections that are left over are given to the pool's
+        # overflow, which is used by the signal bus session, and
+        # during bursts.
+        max_overflow = max(0, connections_per_process - pool_size)
+    prefetch = _get_int(environ, 'dramatiq_queue_prefetch') or threads * PREFETCH_PER_THREAD
+
+    return {
+        'DRAMATIQ_PROCESSES': processes,
+        threads_name: threads,
+        'dramatiq_queue_prefetch': prefetch,
+        'SQLALCHEMY_POOL_SIZE': pool_size,
+        'SQLALCHEMY_MAX_OVERFLOW': max_overflow,
+    }
+
+
+def _get_int(environ: Mapping[str, str], name: str) -> Optional[int]:
+    value = environ.get(name, '')
+    return None if value in ['', 'None'] else int(value)
+
+
+if __name__ == '__main__':  # pragma: no cover
+    for name, value in calc_sizing(os.environ, get_cpu_count(), gevent='--gevent' in sys.argv).items():
+        print(f'export {name}={value}')
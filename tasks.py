@@ -8,12 +8,18 @@ else:
     load_dotenv()
 
 from swpt_payments import create_app  # noqa
-from swpt_payments.extensions import broker  # noqa
+from swpt_payments.extensions import broker, get_consumed_queue_names  # noqa
 import swpt_payments.actors  # noqa
 
 app = create_app()
 broker.set_default()
 
+# When messages are spread among several queues (shards, or
+# load-balancing partitions), the workers consume from all of them,
+# unless they are started with the "--queues" option.
+for queue_name in get_consumed_queue_names():
+    broker.declare_queue(queue_name)
+
 if __name__ == '__main__':
     import sys
     print(
@@ -1,12 +1,18 @@
+import os
 import pytest
 import sqlalchemy
 import flask_migrate
 from unittest import mock
 from swpt_payments import create_app
 from swpt_payments.extensions import db
+from swpt_payments.procedures import clear_caches
 
 DB_SESSION = 'swpt_payments.extensions.db.session'
 
+# The listing endpoints are registered only when the header is
+# configured. (The routes are imported by `create_app()`.)
+os.environ.setdefault('APP_CREDITOR_ID_HEADER', 'X-Swpt-Creditor-Id')
+
 
 def _restart_savepoint(session, transaction):
     if transaction.nested and not transaction._parent.nested:
@@ -40,6 +46,7 @@ def db_session(app):
     """
 
     db.signalbus.autoflush = False
+    clear_caches()
     engines_by_table = db.get_binds()
     connections_by_engine = {engine: engine.connect() for engine in set(engines_by_table.values())}
     transactions = [connection.begin() for connection in connections_by_engine.values()]
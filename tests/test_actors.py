@@ -1,4 +1,13 @@
+import time
+import pytest
+import iso8601
+import dramatiq
+from base64 import urlsafe_b64decode
+from datetime import datetime, timezone
 from swpt_payments import actors as a
+from swpt_payments import procedures as p
+from swpt_payments.models import FailedPaymentSignal, FormalOffer, CreatedFormalOfferSignal, \
+    CanceledFormalOfferSignal, DescriptionBlob
 
 D_ID = -1
 C_ID = 1
@@ -17,6 +26,21 @@ def test_create_formal_offer(db_session):
     )
 
 
+def test_create_formal_offer_too_big_description(db_session):
+    a.create_formal_offer(
+        payee_creditor_id=C_ID,
+        offer_announcement_id=1,
+        debtor_ids=[D_ID],
+        debtor_amounts=[1000],
+        valid_until_ts='2099-12-31T00:00:00Z',
+        description={'text': 'x' * p.MAX_OFFER_DESCRIPTION_BYTES},
+    )
+    assert FormalOffer.query.count() == 0
+    assert DescriptionBlob.query.count() == 0
+    cfos = CreatedFormalOfferSignal.query.one()
+    assert CanceledFormalOfferSignal.query.one().offer_id == cfos.offer_id
+
+
 def test_cancel_formal_offer(db_session):
     a.cancel_formal_offer(
         payee_creditor_id=C_ID,
@@ -39,6 +63,22 @@ def test_make_payment_order(db_session):
     )
 
 
+def test_make_payment_order_too_big_payer_note(db_session):
+    a.make_payment_order(
+        payee_creditor_id=C_ID,
+        offer_id=1,
+        offer_secret='qwer',
+        payer_creditor_id=2,
+        payer_payment_order_seqnum=1,
+        debtor_id=D_ID,
+        amount=1000,
+        proof_secret='asdf',
+        payer_note={'note': 'x' * p.MAX_PAYER_NOTE_BYTES},
+    )
+    fps = FailedPaymentSignal.query.one()
+    assert fps.details['error_code'] == 'PAY008'
+
+
 def test_on_prepared_payment_transfer_signal(db_session):
     a.on_prepared_payment_transfer_signal(
         debtor_id=D_ID,
@@ -60,3 +100,78 @@ def test_on_rejected_payment_transfer_signal(db_session):
         coordinator_request_id=1,
         details={'error_code': '123456', 'message': 'Oops!'},
     )
+
+
+def test_parse_timestamp():
+    assert a._parse_timestamp('2019-12-31T00:00:00Z') == datetime(2019, 12, 31, tzinfo=timezone.utc)
+    assert a._parse_timestamp('2019-12-31T02:00:00.5+02:00') == datetime(2019, 12, 31, 0, 0, 0, 500000, timezone.utc)
+    assert a._parse_timestamp('2019-12-31T00:00:00') == datetime(2019, 12, 31, tzinfo=timezone.utc)
+    assert a._parse_timestamp('20191231T000000Z') == datetime(2019, 12, 31, tzinfo=timezone.utc)
+    with pytest.raises(iso8601.ParseError):
+        a._parse_timestamp('INVALID')
+
+
+def test_message_encoder():
+    message = dramatiq.Message(
+        queue_name='test',
+        actor_name='test',
+        args=(),
+        kwargs={'payer_note': {'text': 'Ünicode'}, 'amount': -(1 << 63)},
+        options={},
+    )
+    assert dramatiq.Message.decode(message.encode()) == message
+
+
+@pytest.mark.slow
+def test_message_decode_overhead():
+    secret = 'MTIz'
+    messages = {
+        'create_formal_offer': (
+            {'payee_creditor_id': C_ID, 'offer_announcement_id': 1, 'debtor_ids': [D_ID], 'debtor_amounts': [1000],
+             'valid_until_ts': '2019-12-31T00:00:00Z', 'description': {'text': 'test'}},
+            lambda kw: (p._get_json_size(kw['description']), a._parse_timestamp(kw['valid_until_ts'])),
+        ),
+        'cancel_formal_offer': (
+            {'payee_creditor_id': C_ID, 'offer_id': 1, 'offer_secret': secret},
+            lambda kw: urlsafe_b64decode(kw['offer_secret']),
+        ),
+        'make_payment_order': (
+            {'payee_creditor_id': C_ID, 'offer_id': 1, 'offer_secret': secret, 'payer_creditor_id': 2,
+             'payer_payment_order_seqnum': 1, 'debtor_id': D_ID, 'amount': 1000, 'proof_secret': secret,
+             'payer_note': {'text': 'test'}},
+            lambda kw: (
+                p._get_json_size(kw['payer_note']),
+                urlsafe_b64decode(kw['offer_secret']),
+                urlsafe_b64decode(kw['proof_secret']),
+            ),
+        ),
+        'on_prepared_payment_transfer_signal': (
+            {'debtor_id': D_ID, 'sender_creditor_id': 2, 'transfer_id': 1, 'coordinator_type': 'payment',
+             'recipient_creditor_id': C_ID, 'sender_locked_amount': 1000, 'prepared_at_ts': '2019-12-31T00:00:00Z',
+             'coordinator_id': C_ID, 'coordinator_request_id': 1},
+            lambda kw: None,
+        ),
+        'on_rejected_payment_transfer_signal': (
+            {'coordinator_type': 'payment', 'coordinator_id': C_ID, 'coordinator_request_id': 1,
+             'details': {'error_code': 'TEST'}},
+            lambda kw: None,
+        ),
+    }
+    n = 10000
+    print()
+    for actor_name, (kwargs, convert) in messages.items():
+        body = dramatiq.Message(queue_name='test', actor_name=actor_name, args=(), kwargs=kwargs, options={}).encode()
+        started_at = time.perf_counter()
+        for _ in range(n):
+            convert(dramatiq.Message.decode(body).kwargs)
+        print(f'{actor_name}: {(time.perf_counter() - started_at) / n * 1e6:.1f}us per message')
+
+    def measure(parse):
+        started_at = time.perf_counter()
+        for _ in range(n):
+            parse('2019-12-31T00:00:00Z')
+        return time.perf_counter() - started_at
+
+    fast, slow = measure(a._parse_timestamp), measure(iso8601.parse_date)
+    print(f'timestamp parsing: {fast / n * 1e6:.1f}us (iso8601: {slow / n * 1e6:.1f}us)')
+    assert fast < slow
@@ -1,7 +1,10 @@
 import pytest
+from unittest import mock
 from datetime import datetime, timezone
 from swpt_payments import procedures as p
-from swpt_payments.models import PaymentOrder, PaymentProof
+from swpt_payments.cli import _FlushingWorkers
+from swpt_payments.models import PaymentOrder, PaymentProof, FormalOffer, CanceledFormalOfferSignal, \
+    FailedPaymentSignal, PrepareTransferSignal
 
 
 @pytest.fixture(scope='function')
@@ -23,13 +26,38 @@ def proof(db_session, offer):
         reciprocal_payment_amount=offer.reciprocal_payment_amount,
         offer_id=offer.offer_id,
         offer_created_at_ts=offer.created_at_ts,
-        offer_description=offer.description,
+        offer_description_hash=offer.description_hash,
     )
     db_session.add(payment_proof)
     db_session.flush()
     return payment_proof
 
 
+def test_subscribe_shards(app, mocker):
+    from swpt_payments.extensions import broker, get_shard_queue_name
+
+    # The actors declare their queue when imported, so they are
+    # imported before `declare_queue` gets mocked.
+    import swpt_payments.actors  # noqa
+
+    mocker.patch('swpt_payments.extensions.APP_QUEUE_SHARDS', 3)
+    channel = mocker.patch.object(type(broker), 'channel', new_callable=mock.PropertyMock).return_value
+    declare_queue = mocker.patch.object(type(broker), 'declare_queue')
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=['swpt_payments', 'subscribe', 'q'])
+    assert not result.exception
+    assert [c[0][0] for c in declare_queue.call_args_list] == ['q.0', 'q.1', 'q.2']
+    bindings = {c[0] for c in channel.queue_bind.call_args_list}
+    assert ('q.0', 'dramatiq', 'q') in bindings
+    assert ('q.0', 'dramatiq', 'events.on_prepared_payment_transfer_signal') in bindings
+    for creditor_id in range(-10, 10):
+        shard_queue_name = get_shard_queue_name(creditor_id, 'q', 3)
+        shard = shard_queue_name.rsplit('.', 1)[1]
+        assert (shard_queue_name, 'dramatiq', shard_queue_name) in bindings
+        assert (shard_queue_name, 'dramatiq', f'events.on_prepared_payment_transfer_signal.{shard}') in bindings
+        assert (shard_queue_name, 'dramatiq', f'events.on_rejected_payment_transfer_signal.{shard}') in bindings
+
+
 def test_flush_payment_orders(app, db_session, offer):
     p.make_payment_order(offer.payee_creditor_id, offer.offer_id, offer.offer_secret, 234, 3456, 3, 1000, b'123', {})
     assert len(PaymentOrder.query.all()) == 1
@@ -47,3 +75,65 @@ def test_flush_payment_proofs(app, db_session, proof):
     assert '1 ' in result.output
     assert 'deleted' in result.output
     assert len(PaymentOrder.query.all()) == 0
+
+
+def test_cancel_expired_offers(app, db_session, offer):
+    assert len(FormalOffer.query.all()) == 1
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=['swpt_payments', 'cancel_expired_offers', '--days', '1.0', '--batch-size', '1'])
+    assert '1 ' in result.output
+    assert 'canceled' in result.output
+    assert len(FormalOffer.query.all()) == 0
+    assert len(CanceledFormalOfferSignal.query.all()) == 1
+
+
+def test_process_stale_payment_orders(app, db_session):
+    deadline = datetime(2099, 1, 1, tzinfo=timezone.utc)
+    offer = p.create_formal_offer(1, 2, [3, 4], [1000, 2000], deadline, {'text': 'test'})
+    p.make_payment_order(offer.payee_creditor_id, offer.offer_id, offer.offer_secret, 234, 3456, 3, 1000, b'123', {})
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=['swpt_payments', 'process_stale_payment_orders', '--abort-hours', '1.0'])
+    assert result.exit_code == 0
+    assert PaymentOrder.query.one().finalized_at_ts is None
+
+    result = runner.invoke(args=['swpt_payments', 'process_stale_payment_orders', '--abort-hours', '-1.0'])
+    assert '1 ' in result.output
+    assert 'aborted' in result.output
+    assert PaymentOrder.query.one().finalized_at_ts is not None
+    assert FailedPaymentSignal.query.one().details['error_code'] == 'PAY007'
+
+
+def test_flush_signals(app, db_session):
+    deadline = datetime(2099, 1, 1, tzinfo=timezone.utc)
+    offer = p.create_formal_offer(1, 2, [3, 4], [1000, 2000], deadline, {'text': 'test'})
+    p.make_payment_order(offer.payee_creditor_id, offer.offer_id, offer.offer_secret, 234, 3456, 3, 1000, b'123', {})
+    runner = app.test_cli_runner()
+    with mock.patch.object(PrepareTransferSignal, 'send_signalbus_messages') as send:
+        result = runner.invoke(args=[
+            'swpt_payments', 'flush_signals', '--threads', '1', '--wait', '3600', 'PrepareTransferSignal',
+        ])
+        assert result.exit_code == 0
+        assert not send.called
+        assert PrepareTransferSignal.query.count() == 1
+
+        result = runner.invoke(args=[
+            'swpt_payments', 'flush_signals', '--threads', '1', '--burst-count', '1', '--wait', '-10.0',
+            'PrepareTransferSignal', 'NonExistingSignal',
+        ])
+        assert result.exit_code == 0
+        assert 'NonExistingSignal' in result.output
+        assert '1 signal has been sent' in result.output
+        assert send.call_count == 1
+        assert PrepareTransferSignal.query.count() == 0
+
+
+def test_flushing_workers(app, mocker):
+    close = mocker.patch('swpt_payments.cli.close_publishing_connection')
+    workers = _FlushingWorkers(app, 3)
+    assert workers.map(lambda n: 2 * n, range(10)) == [2 * n for n in range(10)]
+    assert workers.map(lambda n: n, [5]) == [5]
+    with pytest.raises(ZeroDivisionError):
+        workers.map(lambda n: 1 / n, [1, 0])
+    assert close.call_count == 0
+    workers.shutdown()
+    assert close.call_count == 3
@@ -0,0 +1,131 @@
+import sys
+import subprocess
+import pytest
+import pika
+import dramatiq
+from collections import Counter
+from swpt_payments.extensions import get_shard_queue_names, get_shard_queue_name, get_partition_queue_names, \
+    make_psycopg2_green, publish_messages, close_publishing_connection, broker
+
+
+def test_get_shard_queue_names():
+    assert get_shard_queue_names('q', 1) == ['q']
+    assert get_shard_queue_names('q', 3) == ['q.0', 'q.1', 'q.2']
+
+
+def test_get_shard_queue_name():
+    assert get_shard_queue_name(123, 'q', 1) == 'q'
+    assert get_shard_queue_name(-123, 'q', 4) == get_shard_queue_name(-123, 'q', 4)
+    counts = Counter(get_shard_queue_name(creditor_id, 'q', 4) for creditor_id in range(1000))
+    assert set(counts) == {'q.0', 'q.1', 'q.2', 'q.3'}
+    assert min(counts.values()) > 150
+
+    # Adding a shard moves payees only to the new shard.
+    for creditor_id in range(1000):
+        shard = get_shard_queue_name(creditor_id, 'q', 5)
+        assert shard == 'q.4' or shard == get_shard_queue_name(creditor_id, 'q', 4)
+
+
+def test_get_partition_queue_names():
+    assert get_partition_queue_names('q', [1]) == ['q.p0']
+    assert get_partition_queue_names('q', [1, 2, 1]) == ['q.p0', 'q.p1', 'q.p2']
+
+
+def test_publish_messages(mocker):
+    channel = mocker.Mock()
+    mocker.patch('swpt_payments.extensions._get_transactional_channel', return_value=channel)
+    messages = [
+        (dramatiq.Message(queue_name='q', actor_name='a', args=(), kwargs={'n': n}, options={}), 'q')
+        for n in range(3)
+    ]
+    publish_messages(messages, exchange='e')
+    assert channel.basic_publish.call_count == 3
+    assert channel.basic_publish.call_args[1]['body'] == messages[2][0].encode()
+    channel.tx_commit.assert_called_once_with()
+
+
+def test_publish_messages_reconnect(app, mocker):
+    broken_channel, channel = mocker.Mock(), mocker.Mock()
+    broken_channel.tx_commit.side_effect = pika.exceptions.AMQPConnectionError
+    mocker.patch('swpt_payments.extensions._get_transactional_channel', side_effect=[broken_channel, channel])
+    publish_messages([(dramatiq.Message(queue_name='q', actor_name='a', args=(), kwargs={}, options={}), 'q')])
+    assert channel.basic_publish.call_count == 1
+    channel.tx_commit.assert_called_once_with()
+
+
+def test_close_publishing_connection(app, mocker):
+    connection = mocker.Mock()
+    broker.state.connection = connection
+    broker.connections.add(connection)
+    close_publishing_connection()
+    connection.close.assert_called_once_with()
+    assert connection not in broker.connections
+    assert getattr(broker.state, 'connection', None) is None
+
+    # Does nothing when there is no connection.
+    close_publishing_connection()
+
+
+def test_make_psycopg2_green():
+    # The test process is not monkey-patched by gevent.
+    assert not make_psycopg2_green()
+
+
+# Executes `WORKERS` concurrent I/O-bound "actors", each doing
+# several database round-trips that take 10ms on the server, and
+# prints the number of actor calls per second.
+THROUGHPUT_BENCHMARK = """
+import sys
+mode = sys.argv[1]
+if mode.startswith('gevent'):
+    from gevent import monkey
+    monkey.patch_all()
+import time
+from concurrent.futures import ThreadPoolExecutor
+from swpt_payments import create_app
+from swpt_payments.extensions import db
+
+WORKERS, CALLS = 20, 200
+if mode == 'gevent-blocking':
+    import swpt_payments.extensions
+    swpt_payments.extensions.make_psycopg2_green = lambda: False
+app = create_app({'SQLALCHEMY_POOL_SIZE': WORKERS})
+
+def actor(i):
+    with engine.connect() as connection:
+        for _ in range(3):
+            connection.execute('SELECT pg_sleep(0.01)')
+
+with app.app_context():
+    engine = db.engine
+    actor(0)
+    started_at = time.perf_counter()
+    if mode == 'threads':
+        with ThreadPoolExecutor(max_workers=WORKERS) as executor:
+            list(executor.map(actor, range(CALLS)))
+    else:
+        from gevent.pool import Pool
+        Pool(WORKERS).map(actor, range(CALLS))
+    print(CALLS / (time.perf_counter() - started_at))
+"""
+
+
+@pytest.mark.slow
+def test_threads_vs_greenlets_throughput(app):
+    pytest.importorskip('gevent')
+
+    def measure(mode):
+        output = subprocess.run(
+            [sys.executable, '-c', THROUGHPUT_BENCHMARK, mode],
+            stdout=subprocess.PIPE,
+            check=True,
+        ).stdout
+        return float(output.decode().split()[-1])
+
+    threads, greenlets, blocking_greenlets = measure('threads'), measure('gevent'), measure('gevent-blocking')
+    print(f'\nthreads: {threads:.0f}/s, greenlets: {greenlets:.0f}/s, '
+          f'greenlets without wait callback: {blocking_greenlets:.0f}/s')
+
+    # A serial execution would take at least 30ms per call.
+    assert greenlets > 5 * blocking_greenlets
+    assert blocking_greenlets < 1 / 0.03 + 1
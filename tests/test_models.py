@@ -0,0 +1,55 @@
+import pytest
+import dramatiq
+from datetime import datetime, timezone
+from swpt_payments import models as m
+
+TS = datetime(2019, 12, 31, 1, 2, 3, 456, tzinfo=timezone.utc)
+
+
+@pytest.mark.parametrize('signal', [
+    m.CreatedFormalOfferSignal(
+        payee_creditor_id=1, offer_id=2, offer_announcement_id=3, offer_secret=b'123', offer_created_at_ts=TS),
+    m.CanceledFormalOfferSignal(payee_creditor_id=1, offer_id=2),
+    m.FailedReciprocalPaymentSignal(payee_creditor_id=1, offer_id=2, details={'error_code': 'TEST'}),
+    m.SuccessfulPaymentSignal(
+        payee_creditor_id=1, offer_id=2, payer_creditor_id=3, payer_payment_order_seqnum=4, debtor_id=-5,
+        amount=1000, payer_note={'text': 'test'}, paid_at_ts=TS, reciprocal_payment_debtor_id=None,
+        reciprocal_payment_amount=0, proof_id=6),
+    m.FailedPaymentSignal(
+        payee_creditor_id=1, offer_id=2, payer_creditor_id=3, payer_payment_order_seqnum=4, details={}),
+    m.PrepareTransferSignal(
+        payee_creditor_id=1, coordinator_request_id=2, min_amount=1000, max_amount=1000, debtor_id=-5,
+        sender_creditor_id=3, recipient_creditor_id=1, inserted_at_ts=TS),
+    m.FinalizePreparedTransferSignal(
+        payee_creditor_id=1, signal_id=2, debtor_id=-5, sender_creditor_id=3, transfer_id=4,
+        committed_amount=1000, transfer_info={'text': 'test'}),
+])
+def test_signal_dumper(app, signal):
+    model = type(signal)
+    assert m.get_signal_dumper(model)(signal) == model.__marshmallow_schema__.dump(signal)
+
+
+def test_msgpack_message(app):
+    pytest.importorskip('msgpack')
+    message = m.MsgpackMessage(
+        queue_name='swpt_accounts',
+        actor_name='prepare_transfer',
+        args=(),
+        kwargs={'coordinator_type': 'payment', 'coordinator_id': -(1 << 63), 'signal_ts': TS.isoformat()},
+        options={},
+    )
+    body = message.encode()
+    assert not body.startswith(b'{')
+    assert dramatiq.Message.decode(body) == message
+
+
+def test_outgoing_message_is_not_addressed(app):
+    # The outbox contains signals addressed to any queue, and
+    # therefore it must not look like a signal for another service.
+    assert m.OutgoingMessage.queue_name is None
+    message = m.PrepareTransferSignal(
+        payee_creditor_id=1, coordinator_request_id=2, min_amount=1000, max_amount=1000, debtor_id=-5,
+        sender_creditor_id=3, recipient_creditor_id=1, inserted_at_ts=TS,
+    ).create_outgoing_message()
+    assert message.target_queue == 'swpt_accounts'
+    assert message.routing_key == 'swpt_accounts'
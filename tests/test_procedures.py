@@ -1,10 +1,15 @@
+import time
+import json
 import pytest
-from datetime import datetime, timezone
+import dramatiq
+from sqlalchemy import event
+from datetime import datetime, timezone, timedelta
 from swpt_payments import __version__
 from swpt_payments import procedures as p
+from swpt_payments.extensions import db
 from swpt_payments.models import FormalOffer, CreatedFormalOfferSignal, PaymentOrder, CanceledFormalOfferSignal, \
     FailedPaymentSignal, PrepareTransferSignal, FinalizePreparedTransferSignal, SuccessfulPaymentSignal, \
-    PaymentProof, FailedReciprocalPaymentSignal, get_now_utc
+    PaymentProof, FailedReciprocalPaymentSignal, DescriptionBlob, OutgoingMessage, get_now_utc
 
 
 def test_version(db_session):
@@ -55,7 +60,7 @@ def test_create_formal_offer(db_session, offer):
     assert fo.debtor_ids == [D_ID, D_ID - 1]
     assert fo.debtor_amounts == [AMOUNT1, AMOUNT2]
     assert fo.valid_until_ts == VALID_UNTIL_TS
-    assert fo.description in [None, DESCRIPTION]
+    assert p.get_description(fo.description_hash) in [None, DESCRIPTION]
     assert fo.reciprocal_payment_debtor_id in [D_ID - 2, None]
     assert fo.reciprocal_payment_amount in [AMOUNT3, 0]
     assert fo.offer_id is not None
@@ -69,6 +74,80 @@ def test_create_formal_offer(db_session, offer):
     assert cfos.offer_created_at_ts == fo.created_at_ts
 
 
+def test_create_formal_offer_without_update(db_session):
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        fo = p.create_formal_offer(
+            C_ID, OFFER_ANNOUNCEMENT_ID, [D_ID], [AMOUNT1], VALID_UNTIL_TS, DESCRIPTION)
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+    assert fo.document is not None
+    assert not [s for s in statements if s.startswith('UPDATE formal_offer')]
+
+
+def test_description_deduplication(db_session):
+    o1 = p.create_formal_offer(C_ID, OFFER_ANNOUNCEMENT_ID, [D_ID], [AMOUNT1], VALID_UNTIL_TS, DESCRIPTION)
+    o2 = p.create_formal_offer(C_ID, OFFER_ANNOUNCEMENT_ID + 1, [D_ID], [AMOUNT2], VALID_UNTIL_TS, dict(DESCRIPTION))
+    o3 = p.create_formal_offer(C_ID, OFFER_ANNOUNCEMENT_ID + 2, [D_ID], [AMOUNT2], VALID_UNTIL_TS, None)
+    assert o1.description_hash == o2.description_hash
+    assert o3.description_hash is None
+    assert len(DescriptionBlob.query.all()) == 1
+    assert p.get_description(o1.description_hash) == DESCRIPTION
+    assert p.get_description(o3.description_hash) is None
+
+
+def test_flush_unreferenced_descriptions(db_session, offer):
+    p.flush_payment_proofs(get_now_utc())
+    assert len(DescriptionBlob.query.all()) == (0 if offer.description_hash is None else 1)
+
+    p.cancel_formal_offer(offer.payee_creditor_id, offer.offer_id, offer.offer_secret)
+    assert len(DescriptionBlob.query.all()) == 0
+
+
+def test_flush_unreferenced_descriptions_only_deleted(db_session):
+    o1 = p.create_formal_offer(C_ID, OFFER_ANNOUNCEMENT_ID, [D_ID], [AMOUNT1], VALID_UNTIL_TS, DESCRIPTION)
+    p.create_formal_offer(C_ID, OFFER_ANNOUNCEMENT_ID + 1, [D_ID], [AMOUNT1], VALID_UNTIL_TS, {'text': 'other'})
+    p.create_formal_offer(C_ID, OFFER_ANNOUNCEMENT_ID + 2, [D_ID], [AMOUNT1], VALID_UNTIL_TS, dict(DESCRIPTION))
+    assert len(DescriptionBlob.query.all()) == 2
+    p.cancel_formal_offer(o1.payee_creditor_id, o1.offer_id, o1.offer_secret)
+    assert len(DescriptionBlob.query.all()) == 2
+    assert p.cancel_expired_formal_offers(datetime(2999, 1, 1, tzinfo=timezone.utc), 10) == 2
+    assert len(DescriptionBlob.query.all()) == 0
+
+
+def test_outbox(db_session, mocker):
+    mocker.patch('swpt_payments.models.USE_OUTBOX', True)
+    deadline = datetime(2099, 1, 1, tzinfo=timezone.utc)
+    offer = p.create_formal_offer(C_ID, 1, [D_ID], [1000], deadline, {'text': 'test'})
+    p.cancel_formal_offer(offer.payee_creditor_id, offer.offer_id, offer.offer_secret)
+    assert CreatedFormalOfferSignal.query.count() == 0
+    assert CanceledFormalOfferSignal.query.count() == 0
+    messages = OutgoingMessage.query.order_by(OutgoingMessage.message_id).all()
+    assert [m.routing_key for m in messages] == [
+        'events.on_created_formal_offer_signal',
+        'events.on_canceled_formal_offer_signal',
+    ]
+    message = dramatiq.Message.decode(messages[1].payload)
+    assert message.actor_name == 'on_canceled_formal_offer_signal'
+    assert message.kwargs == {'payee_creditor_id': C_ID, 'offer_id': offer.offer_id}
+
+    sent = []
+    mocker.patch('swpt_payments.models.publish_messages', side_effect=lambda messages, exchange: sent.extend(messages))
+    assert p.flush_signals(OutgoingMessage, datetime(2099, 1, 1, tzinfo=timezone.utc), 1) == 1
+    assert p.flush_signals(OutgoingMessage, datetime(2099, 1, 1, tzinfo=timezone.utc), 10) == 1
+    assert [routing_key for _, routing_key in sent] == [
+        'events.on_created_formal_offer_signal',
+        'events.on_canceled_formal_offer_signal',
+    ]
+    assert [message.encode() for message, _ in sent] == [m.payload for m in messages]
+    assert OutgoingMessage.query.count() == 0
+
+
 def test_make_payment_order_wrong_amount(db_session, offer):
     p.make_payment_order(offer.payee_creditor_id, offer.offer_id, offer.offer_secret, C_ID + 1,
                          PAYER_PAYMENT_ORDER_SEQNUM, D_ID, 1001, PROOF_SECRET, PAYER_NOTE)
@@ -89,12 +168,43 @@ def test_make_payment_order_wrong_debtor(db_session, offer):
     assert fps.details['error_code'] == 'PAY002'
 
 
+def test_make_payment_order_sanitized_amounts(db_session):
+    offer = p.create_formal_offer(
+        C_ID, OFFER_ANNOUNCEMENT_ID, [D_ID, D_ID, D_ID - 1], [0, AMOUNT1, AMOUNT2], VALID_UNTIL_TS, DESCRIPTION,
+        D_ID - 2, AMOUNT3)
+    FormalOffer.query.filter_by(payee_creditor_id=offer.payee_creditor_id, offer_id=offer.offer_id).update(
+        {'debtor_amounts': [None, AMOUNT1, -AMOUNT2]}, synchronize_session=False)
+    for seqnum, (debtor_id, amount) in enumerate([(D_ID, 0), (D_ID, AMOUNT1), (D_ID - 1, 0)]):
+        p.make_payment_order(offer.payee_creditor_id, offer.offer_id, offer.offer_secret, C_ID + 1,
+                             seqnum, debtor_id, amount, PROOF_SECRET, PAYER_NOTE)
+    assert len(PaymentOrder.query.all()) == 3
+    assert len(FailedPaymentSignal.query.all()) == 0
+
+    p.make_payment_order(offer.payee_creditor_id, offer.offer_id, offer.offer_secret, C_ID + 1,
+                         PAYER_PAYMENT_ORDER_SEQNUM, D_ID - 1, AMOUNT2, PROOF_SECRET, PAYER_NOTE)
+    fps = FailedPaymentSignal.query.one()
+    assert fps.details['error_code'] == 'PAY003'
+
+
 def test_make_payment_order_wrong_offer(db_session, offer):
     p.make_payment_order(offer.payee_creditor_id, offer.offer_id + 1, offer.offer_secret, C_ID + 1,
                          PAYER_PAYMENT_ORDER_SEQNUM, D_ID, 1000, PROOF_SECRET, PAYER_NOTE)
     assert len(PaymentOrder.query.all()) == 0
     fps = FailedPaymentSignal.query.one()
     assert fps.details['error_code'] == 'PAY001'
+    assert p.get_cache_stats()['missing_formal_offers']['size'] == 1
+
+    # Known missing offers are rejected without hitting the database.
+    p.make_payment_order(offer.payee_creditor_id, offer.offer_id + 1, offer.offer_secret, C_ID + 1,
+                         PAYER_PAYMENT_ORDER_SEQNUM + 1, D_ID, 1000, PROOF_SECRET, PAYER_NOTE)
+    assert len(FailedPaymentSignal.query.all()) == 2
+    assert p.get_cache_stats()['missing_formal_offers']['hits'] == 1
+
+    # A wrong secret does not mean that the offer does not exist.
+    p.make_payment_order(offer.payee_creditor_id, offer.offer_id, b'wrong secret', C_ID + 1,
+                         PAYER_PAYMENT_ORDER_SEQNUM, D_ID, 1000, PROOF_SECRET, PAYER_NOTE)
+    assert len(FailedPaymentSignal.query.all()) == 3
+    assert p.get_cache_stats()['missing_formal_offers']['size'] == 1
 
 
 def test_make_payment_order_wrong_secret(db_session, offer):
@@ -159,6 +269,104 @@ def test_make_payment_order(db_session, offer, payment_order):
     assert fps.details['error_code'] == '123456'
 
 
+def test_make_payment_order_redelivery(db_session, offer, payment_order):
+    # Make sure that the database check catches the re-delivery.
+    p.clear_caches()
+    p.make_payment_order(offer.payee_creditor_id, offer.offer_id, offer.offer_secret, C_ID + 1,
+                         PAYER_PAYMENT_ORDER_SEQNUM, D_ID, 1000, PROOF_SECRET, PAYER_NOTE)
+    po = PaymentOrder.query.one()
+    assert po.payment_coordinator_request_id == payment_order.payment_coordinator_request_id
+    assert po.finalized_at_ts is None
+    assert len(PrepareTransferSignal.query.all()) == 1
+    assert len(FailedPaymentSignal.query.all()) == 0
+
+
+def test_make_payment_order_too_big_payer_note_redelivery(db_session, offer, payment_order):
+    # A re-delivered request must not fail, even if the payer note
+    # is too big.
+    p.clear_caches()
+    p.make_payment_order(offer.payee_creditor_id, offer.offer_id, offer.offer_secret, C_ID + 1,
+                         PAYER_PAYMENT_ORDER_SEQNUM, D_ID, 1000, PROOF_SECRET,
+                         {'note': 'x' * p.MAX_PAYER_NOTE_BYTES})
+    assert len(FailedPaymentSignal.query.all()) == 0
+
+    p.make_payment_order(offer.payee_creditor_id, offer.offer_id, offer.offer_secret, C_ID + 1,
+                         PAYER_PAYMENT_ORDER_SEQNUM + 1, D_ID, 1000, PROOF_SECRET,
+                         {'note': 'x' * p.MAX_PAYER_NOTE_BYTES})
+    assert FailedPaymentSignal.query.one().details['error_code'] == 'PAY008'
+    assert len(PaymentOrder.query.all()) == 1
+
+
+def test_make_payment_order_recent_keys_cache(db_session, offer, payment_order, mocker):
+    stats = p.get_cache_stats()['recent_payment_orders']
+    assert stats == {'size': 1, 'hits': 0, 'misses': 1}
+
+    process_payment_order = mocker.patch('swpt_payments.procedures._process_payment_order')
+    p.make_payment_order(offer.payee_creditor_id, offer.offer_id, offer.offer_secret, C_ID + 1,
+                         PAYER_PAYMENT_ORDER_SEQNUM, D_ID, 1000, PROOF_SECRET, PAYER_NOTE)
+    process_payment_order.assert_not_called()
+    assert p.get_cache_stats()['recent_payment_orders']['hits'] == 1
+
+    p.make_payment_order(offer.payee_creditor_id, offer.offer_id, offer.offer_secret, C_ID + 1,
+                         PAYER_PAYMENT_ORDER_SEQNUM + 1, D_ID, 1000, PROOF_SECRET, PAYER_NOTE)
+    process_payment_order.assert_called_once()
+    assert p.get_cache_stats()['recent_payment_orders'] == {'size': 2, 'hits': 1, 'misses': 2}
+
+
+def test_expiring_key_cache(mocker):
+    monotonic = mocker.patch('time.monotonic', return_value=1000.0)
+    cache = p.ExpiringKeyCache(maxsize=2, ttl=10.0)
+    cache.add(1)
+    cache.add(2)
+    cache.add(3)
+    assert len(cache) == 2
+    assert 1 not in cache
+    assert 2 in cache
+    assert 3 in cache
+    assert (cache.hits, cache.misses) == (2, 1)
+
+    monotonic.return_value = 1005.0
+    cache.add(4)
+    cache.discard(3)
+    assert 3 not in cache
+    monotonic.return_value = 1012.0
+    assert 2 not in cache
+    assert 4 in cache
+    cache.add(5)
+    assert len(cache) == 2
+    monotonic.return_value = 1100.0
+    cache.add(6)
+    assert len(cache) == 1
+
+    cache.clear()
+    assert len(cache) == 0
+    assert (cache.hits, cache.misses) == (0, 0)
+    p.ExpiringKeyCache(maxsize=0, ttl=10.0).add(1)
+
+
+@pytest.mark.parametrize('ttl', [0.0, -1.0])
+def test_expiring_key_cache_zero_ttl(ttl):
+    cache = p.ExpiringKeyCache(maxsize=2, ttl=ttl)
+    cache.add(1)
+    assert len(cache) == 0
+    assert 1 not in cache
+
+
+def test_expiring_key_cache_stats_logging(mocker):
+    monotonic = mocker.patch('time.monotonic', return_value=1000.0)
+    log = mocker.patch.object(p._logger, 'info')
+    cache = p.ExpiringKeyCache(maxsize=2, ttl=10.0, name='test_cache')
+    cache.add(1)
+    assert 1 in cache
+    log.assert_not_called()
+
+    monotonic.return_value = 1000.0 + p.CACHE_STATS_LOG_INTERVAL
+    assert 2 not in cache
+    log.assert_called_once_with('%s: %s', 'test_cache', {'size': 1, 'hits': 1, 'misses': 1})
+    assert 1 not in cache
+    assert log.call_count == 1
+
+
 def test_cancel_formal_offer(db_session, offer, payment_order):
     p.cancel_formal_offer(offer.payee_creditor_id, offer.offer_id, offer.offer_secret)
     cfos = CanceledFormalOfferSignal.query.one()
@@ -176,6 +384,87 @@ def test_cancel_formal_offer(db_session, offer, payment_order):
     assert fps.details['error_code'] == 'PAY004'
 
 
+def test_cancel_expired_formal_offers(db_session, offer, payment_order):
+    assert p.cancel_expired_formal_offers(datetime(2098, 1, 1, tzinfo=timezone.utc), 100) == 0
+    assert len(FormalOffer.query.all()) == 1
+    assert len(CanceledFormalOfferSignal.query.all()) == 0
+
+    assert p.cancel_expired_formal_offers(datetime(2100, 1, 1, tzinfo=timezone.utc), 100) == 1
+    assert len(FormalOffer.query.all()) == 0
+    cfos = CanceledFormalOfferSignal.query.one()
+    assert cfos.payee_creditor_id == offer.payee_creditor_id
+    assert cfos.offer_id == offer.offer_id
+
+    po = PaymentOrder.query.one()
+    assert po.finalized_at_ts is not None
+    fps = FailedPaymentSignal.query.one()
+    assert fps.details['error_code'] == 'PAY004'
+
+
+def test_abort_stale_payment_orders(db_session, offer, payment_order):
+    po = payment_order
+    assert p.abort_stale_payment_orders(po.created_at_ts - timedelta(seconds=1), 100) == 0
+    assert PaymentOrder.query.one().finalized_at_ts is None
+
+    assert p.abort_stale_payment_orders(po.created_at_ts, 100) == 1
+    po = PaymentOrder.query.one()
+    assert po.finalized_at_ts is not None
+    fps = FailedPaymentSignal.query.one()
+    assert fps.payer_creditor_id == po.payer_creditor_id
+    assert fps.payer_payment_order_seqnum == po.payer_payment_order_seqnum
+    assert fps.details['error_code'] == 'PAY007'
+    assert p.abort_stale_payment_orders(po.created_at_ts, 100) == 0
+
+
+def test_resend_stale_prepare_transfer_signals(db_session, offer, payment_order):
+    po = payment_order
+    after_ts = po.created_at_ts - timedelta(days=1)
+    before_ts = po.created_at_ts + timedelta(days=1)
+
+    # The original signal has not been sent yet.
+    assert p.resend_stale_prepare_transfer_signals(after_ts, before_ts, 100) is None
+    pts = PrepareTransferSignal.query.one()
+
+    db_session.delete(pts)
+    db_session.flush()
+    prev = (po.created_at_ts, po.payee_creditor_id, po.payment_coordinator_request_id)
+    assert p.resend_stale_prepare_transfer_signals(after_ts, before_ts, 1) == prev
+    pts = PrepareTransferSignal.query.one()
+    assert pts.payee_creditor_id == po.payee_creditor_id
+    assert pts.coordinator_request_id == po.payment_coordinator_request_id
+    assert pts.min_amount == pts.max_amount == po.amount
+    assert pts.debtor_id == po.debtor_id
+    assert pts.sender_creditor_id == po.payer_creditor_id
+    assert pts.recipient_creditor_id == po.payee_creditor_id
+
+    db_session.delete(pts)
+    db_session.flush()
+    assert p.resend_stale_prepare_transfer_signals(after_ts, before_ts, 100, prev) is None
+    assert len(PrepareTransferSignal.query.all()) == 0
+
+
+def test_resend_stale_prepare_transfer_signals_same_created_at_ts(db_session, offer):
+    for seqnum in range(3):
+        p.make_payment_order(offer.payee_creditor_id, offer.offer_id, offer.offer_secret, C_ID + 1,
+                             seqnum, D_ID, 1000, PROOF_SECRET, PAYER_NOTE)
+    created_at_ts = PaymentOrder.query.first().created_at_ts
+    PaymentOrder.query.update({'created_at_ts': created_at_ts}, synchronize_session=False)
+    PrepareTransferSignal.query.delete()
+    after_ts = created_at_ts - timedelta(days=1)
+    before_ts = created_at_ts + timedelta(days=1)
+
+    # Orders that share a timestamp must not be skipped across batches.
+    prev = p.resend_stale_prepare_transfer_signals(after_ts, before_ts, 2)
+    assert prev is not None
+    assert len(PrepareTransferSignal.query.all()) == 2
+    assert p.resend_stale_prepare_transfer_signals(after_ts, before_ts, 2, prev) is None
+    assert len(PrepareTransferSignal.query.all()) == 3
+
+    # Orders with pending signals are not touched again.
+    assert p.resend_stale_prepare_transfer_signals(after_ts, before_ts, 2) is None
+    assert len(PrepareTransferSignal.query.all()) == 3
+
+
 def test_successful_payment(db_session, offer, payment_order):
     po = payment_order
     coordinator_id = po.payee_creditor_id
@@ -273,8 +562,13 @@ def test_successful_payment(db_session, offer, payment_order):
     assert pp.reciprocal_payment_amount == offer.reciprocal_payment_amount
     assert pp.offer_id == offer.offer_id
     assert pp.offer_created_at_ts == offer.created_at_ts
-    assert pp.offer_description == offer.description
+    assert pp.offer_description_hash == offer.description_hash
     assert p.get_payment_proof(offer.payee_creditor_id, proof_id) is pp
+    document = json.loads(pp.document)
+    assert document['@type'] == 'PaymentProof'
+    assert document['paidAmount'] == pp.amount
+    assert 'offerDescription' not in document
+    assert pp.document_etag
 
     # Canceling the paid offer should do nothing.
     p.cancel_formal_offer(offer.payee_creditor_id, offer.offer_id, offer.offer_secret)
@@ -322,3 +616,140 @@ def test_get_formal_offer(db_session, offer):
     o = p.get_formal_offer(offer.payee_creditor_id, offer.offer_id)
     assert isinstance(o, FormalOffer)
     assert o.offer_secret == offer.offer_secret
+
+
+def test_get_payee_formal_offers(db_session):
+    deadlines = [VALID_UNTIL_TS - timedelta(days=i) for i in range(5)]
+    offers = [p.create_formal_offer(C_ID, OFFER_ANNOUNCEMENT_ID, [D_ID], [AMOUNT1], deadline, DESCRIPTION)
+              for deadline in deadlines]
+    p.create_formal_offer(C_ID + 1, OFFER_ANNOUNCEMENT_ID, [D_ID], [AMOUNT1], VALID_UNTIL_TS, DESCRIPTION)
+    offer_ids = [o.offer_id for o in offers]
+
+    page = p.get_payee_formal_offers(C_ID, 2)
+    assert [o.offer_id for o in page] == offer_ids[:2]
+    page = p.get_payee_formal_offers(C_ID, 2, prev_offer_id=page[-1].offer_id)
+    assert [o.offer_id for o in page] == offer_ids[2:4]
+    page = p.get_payee_formal_offers(C_ID, 2, prev_offer_id=page[-1].offer_id)
+    assert [o.offer_id for o in page] == offer_ids[4:]
+    assert p.get_payee_formal_offers(C_ID, 2, prev_offer_id=offer_ids[-1]) == []
+
+    page = p.get_payee_formal_offers(
+        C_ID, 10, min_valid_until_ts=deadlines[3], max_valid_until_ts=deadlines[0])
+    assert [o.offer_id for o in page] == offer_ids[1:4]
+
+
+def _create_payment_proofs(db_session, payer_creditor_ids, paid_at_timestamps):
+    proofs = [PaymentProof(
+        payee_creditor_id=C_ID,
+        proof_secret=PROOF_SECRET,
+        payer_creditor_id=payer_creditor_id,
+        debtor_id=D_ID,
+        amount=AMOUNT1,
+        paid_at_ts=paid_at_ts,
+        reciprocal_payment_amount=0,
+        offer_id=1,
+        offer_created_at_ts=paid_at_ts,
+    ) for payer_creditor_id, paid_at_ts in zip(payer_creditor_ids, paid_at_timestamps)]
+    db_session.add_all(proofs)
+    db_session.flush()
+    return [(pp.proof_id, pp.paid_at_ts) for pp in proofs]
+
+
+def test_get_payer_payment_proofs(db_session):
+    proofs = _create_payment_proofs(db_session, [C_ID + 1, C_ID + 2, C_ID + 1, C_ID + 1], [VALID_UNTIL_TS] * 4)
+    proof_ids = [proof_id for proof_id, _ in proofs]
+
+    page = p.get_payer_payment_proofs(C_ID + 1, 2)
+    assert [pp.proof_id for pp in page] == [proof_ids[0], proof_ids[2]]
+    page = p.get_payer_payment_proofs(C_ID + 1, 2, prev_proof_id=page[-1].proof_id)
+    assert [pp.proof_id for pp in page] == [proof_ids[3]]
+    assert [pp.proof_id for pp in p.get_payer_payment_proofs(C_ID + 2, 10)] == [proof_ids[1]]
+
+
+def test_get_payee_payment_proofs(db_session):
+    ts = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    paid_at_timestamps = [ts + timedelta(days=1), ts, ts + timedelta(days=1), ts + timedelta(days=3)]
+    proofs = _create_payment_proofs(db_session, [C_ID + 1] * 4, paid_at_timestamps)
+    ordered_proof_ids = [proof_id for proof_id, _ in sorted(proofs, key=lambda x: (x[1], x[0]))]
+
+    page = p.get_payee_payment_proofs(C_ID, 2)
+    assert [pp.proof_id for pp in page] == ordered_proof_ids[:2]
+    page = p.get_payee_payment_proofs(C_ID, 2, prev=(page[-1].paid_at_ts, page[-1].proof_id))
+    assert [pp.proof_id for pp in page] == ordered_proof_ids[2:]
+
+    page = p.get_payee_payment_proofs(C_ID, 10, min_paid_at_ts=ts + timedelta(days=1),
+                                      max_paid_at_ts=ts + timedelta(days=2))
+    assert [pp.proof_id for pp in page] == ordered_proof_ids[1:3]
+    assert p.get_payee_payment_proofs(C_ID + 1, 10) == []
+
+
+def test_missing_formal_offers_cache(db_session, offer):
+    next_offer_id = offer.offer_id + 1
+    assert p.get_formal_offer(C_ID, next_offer_id) is None
+    assert p.get_formal_offer(C_ID, next_offer_id) is None
+    assert p.get_cache_stats()['missing_formal_offers'] == {'size': 1, 'hits': 1, 'misses': 1}
+
+    # Creating the offer invalidates the cached key.
+    new_offer = p.create_formal_offer(
+        C_ID, OFFER_ANNOUNCEMENT_ID, [D_ID], [AMOUNT1], VALID_UNTIL_TS, DESCRIPTION)
+    assert new_offer.offer_id == next_offer_id
+    assert p.get_formal_offer(C_ID, next_offer_id).offer_secret == new_offer.offer_secret
+
+
+def test_missing_payment_proofs_cache(db_session):
+    assert p.get_payment_proof(C_ID, 1234) is None
+    assert p.get_payment_proof(C_ID, 1234) is None
+    assert p.get_cache_stats()['missing_payment_proofs'] == {'size': 1, 'hits': 1, 'misses': 1}
+
+
+def _create_offer_with_failed_payment_orders(db_session, n):
+    offer = p.create_formal_offer(C_ID, OFFER_ANNOUNCEMENT_ID, [D_ID], [AMOUNT1], VALID_UNTIL_TS, DESCRIPTION)
+    current_ts = get_now_utc()
+    if n > 0:
+        db_session.execute(PaymentOrder.__table__.insert(), [dict(
+            payee_creditor_id=offer.payee_creditor_id,
+            offer_id=offer.offer_id,
+            payer_creditor_id=C_ID + 1,
+            payer_payment_order_seqnum=seqnum,
+            debtor_id=D_ID,
+            amount=AMOUNT1,
+            reciprocal_payment_amount=0,
+            payer_note=None,
+            proof_secret=None,
+            created_at_ts=current_ts,
+            finalized_at_ts=current_ts,
+        ) for seqnum in range(n)])
+    p.make_payment_order(offer.payee_creditor_id, offer.offer_id, offer.offer_secret, C_ID + 1,
+                         n, D_ID, AMOUNT1, PROOF_SECRET, PAYER_NOTE)
+    db_session.execute('ANALYZE payment_order')
+    return offer, PaymentOrder.query.filter_by(offer_id=offer.offer_id, payer_payment_order_seqnum=n).one()
+
+
+def _measure_cancel_and_pay_latency(db_session, n):
+    offer, _ = _create_offer_with_failed_payment_orders(db_session, n)
+    started_at = time.perf_counter()
+    p.cancel_formal_offer(offer.payee_creditor_id, offer.offer_id, offer.offer_secret)
+    cancel_latency = time.perf_counter() - started_at
+
+    offer, po = _create_offer_with_failed_payment_orders(db_session, n)
+    started_at = time.perf_counter()
+    p.process_prepared_payment_transfer_signal(
+        po.debtor_id, po.payer_creditor_id, 333, po.payee_creditor_id, AMOUNT1,
+        po.payee_creditor_id, po.payment_coordinator_request_id)
+    pay_latency = time.perf_counter() - started_at
+    assert SuccessfulPaymentSignal.query.filter_by(offer_id=offer.offer_id).one()
+    return cancel_latency, pay_latency
+
+
+@pytest.mark.slow
+def test_cancel_and_pay_latency_with_many_failed_payment_orders(db_session):
+    _measure_cancel_and_pay_latency(db_session, 0)  # warm up
+    cancel_latency, pay_latency = _measure_cancel_and_pay_latency(db_session, 0)
+    cancel_latency_many, pay_latency_many = _measure_cancel_and_pay_latency(db_session, 5000)
+    print(f'\ncancel: {cancel_latency * 1000:.2f}ms -> {cancel_latency_many * 1000:.2f}ms; '
+          f'pay: {pay_latency * 1000:.2f}ms -> {pay_latency_many * 1000:.2f}ms')
+
+    # Finalized payment orders should not be visited. The thresholds
+    # are very generous, so as to avoid random test failures.
+    assert cancel_latency_many < 5 * cancel_latency + 0.05
+    assert pay_latency_many < 5 * pay_latency + 0.05
@@ -1,9 +1,12 @@
 import json
+import gzip
+import time
 import pytest
 from base64 import urlsafe_b64encode
 from datetime import datetime, timezone
 from swpt_payments import procedures
-from swpt_payments.models import PaymentProof
+from swpt_payments.models import FormalOffer, PaymentProof
+from swpt_payments.schemas import add_description, serialize_description
 from swpt_payments.extensions import db
 
 
@@ -35,7 +38,7 @@ def proof(offer):
         reciprocal_payment_amount=offer.reciprocal_payment_amount,
         offer_id=offer.offer_id,
         offer_created_at_ts=offer.created_at_ts,
-        offer_description=offer.description,
+        offer_description_hash=offer.description_hash,
     )
     db.session.add(payment_proof)
     db.session.flush()
@@ -61,7 +64,7 @@ def test_get_offer(client, offer):
     assert contents['@id'].endswith(f'/formal-offers/{offer.payee_creditor_id}/{offer.offer_id}/{offer_secret}')
     assert contents['@type'] == 'FormalOffer'
     assert '@context' in contents
-    assert contents['offerDescription'] == offer.description
+    assert contents['offerDescription'] == procedures.get_description(offer.description_hash)
     assert len(contents['paymentOptions']) == 2
     payment_decsription = contents['paymentOptions'][0]
     assert payment_decsription['via'] == '/debtors/3'
@@ -88,4 +91,229 @@ def test_get_proof(client, offer, proof):
     assert contents['@type'] == 'PaymentProof'
     assert '@context' in contents
     assert contents['paidAmount'] == proof.amount
-    assert contents['offerDescription'] == offer.description
+    assert contents['offerDescription'] == procedures.get_description(offer.description_hash)
+
+
+def _get_offer_document(offer):
+    description = procedures.get_description(offer.description_hash)
+    return add_description(offer.document, serialize_description(description))
+
+
+def test_get_offer_stored_document(client, offer):
+    # The description is not stored in the document.
+    assert offer.document is not None
+    assert b'offerDescription' not in offer.document
+    offer_secret = urlsafe_b64encode(offer.offer_secret).decode()
+    url = f'/formal-offers/{offer.payee_creditor_id}/{offer.offer_id}/{offer_secret}'
+    r = client.get(url)
+    assert r.status_code == 200
+    assert r.data == _get_offer_document(offer)
+    assert json.loads(r.data)['offerDescription'] == procedures.get_description(offer.description_hash)
+    assert r.headers['ETag'] == f'"{offer.document_etag}"'
+
+    r = client.get(url, headers={'If-None-Match': r.headers['ETag']})
+    assert r.status_code == 304
+    assert r.data == b''
+
+
+def test_get_proof_etag(client, offer, proof):
+    assert proof.document is None
+    proof_secret = urlsafe_b64encode(proof.proof_secret).decode()
+    url = f'/payment-proofs/{proof.payee_creditor_id}/{proof.proof_id}/{proof_secret}'
+    r = client.get(url)
+    etag = r.headers['ETag']
+    proof.document = r.data
+    proof.document_etag = etag.strip('"')
+    db.session.flush()
+    r = client.get(url)
+    assert r.status_code == 200
+    assert r.headers['ETag'] == etag
+    assert client.get(url, headers={'If-None-Match': etag}).status_code == 304
+
+
+@pytest.fixture(scope='function')
+def big_offer(db_session):
+    description = {'text': 'A detailed description of the goods. ' * 50}
+    debtor_ids = list(range(1, 51))
+    return procedures.create_formal_offer(
+        1, 2, debtor_ids, [1000] * len(debtor_ids), datetime(2099, 1, 1, tzinfo=timezone.utc), description)
+
+
+def _get_offer_url(offer):
+    offer_secret = urlsafe_b64encode(offer.offer_secret).decode()
+    return f'/formal-offers/{offer.payee_creditor_id}/{offer.offer_id}/{offer_secret}'
+
+
+def test_get_offer_compressed(client, big_offer):
+    url = _get_offer_url(big_offer)
+    r = client.get(url)
+    assert 'Content-Encoding' not in r.headers
+    assert r.headers['Vary'] == 'Accept-Encoding'
+    assert r.data == _get_offer_document(big_offer)
+
+    r = client.get(url, headers={'Accept-Encoding': 'gzip, deflate'})
+    assert r.status_code == 200
+    assert r.headers['Content-Encoding'] == 'gzip'
+    assert r.headers['Vary'] == 'Accept-Encoding'
+    assert r.headers['ETag'] == f'"{big_offer.document_etag}-gzip"'
+    assert len(r.data) < len(big_offer.document)
+    assert gzip.decompress(r.data) == _get_offer_document(big_offer)
+
+    r = client.get(url, headers={'Accept-Encoding': 'gzip', 'If-None-Match': r.headers['ETag']})
+    assert r.status_code == 304
+
+    r = client.get(url, headers={'Accept-Encoding': 'gzip;q=0, identity'})
+    assert 'Content-Encoding' not in r.headers
+
+
+def test_get_offer_brotli(client, big_offer):
+    brotli = pytest.importorskip('brotli')
+    r = client.get(_get_offer_url(big_offer), headers={'Accept-Encoding': 'gzip, br'})
+    assert r.headers['Content-Encoding'] == 'br'
+    assert brotli.decompress(r.data) == _get_offer_document(big_offer)
+
+
+def test_get_small_offer_not_compressed(client, offer):
+    FormalOffer.query.filter_by(payee_creditor_id=offer.payee_creditor_id, offer_id=offer.offer_id).update(
+        {'document': b'{"offerId": 1}'}, synchronize_session=False)
+    r = client.get(_get_offer_url(offer), headers={'Accept-Encoding': 'gzip'})
+    assert json.loads(r.data)['offerId'] == 1
+    assert 'Content-Encoding' not in r.headers
+
+
+def test_get_context(client, offer):
+    r = client.get('/contexts/FormalOffer.jsonld')
+    assert r.status_code == 200
+    assert r.content_type == 'application/ld+json'
+    assert 'immutable' in r.headers['Cache-Control']
+    context = json.loads(r.data)['@context']
+    assert context['offerDescription'] == {'@type': '@json'}
+    etag = r.headers['ETag']
+    assert not etag.startswith('W/')
+    assert client.get('/contexts/FormalOffer.jsonld', headers={'If-None-Match': etag}).status_code == 304
+
+    # Every offer refers to an existing context.
+    offer_context_url = json.loads(client.get(_get_offer_url(offer)).data)['@context']
+    assert client.get(offer_context_url).status_code == 200
+    assert client.get('/contexts/PaymentProof.jsonld').status_code == 200
+    assert client.get('/contexts/Unknown.jsonld').status_code == 404
+
+
+def test_get_offer_inline_context(client, offer):
+    url = _get_offer_url(offer)
+    context = json.loads(client.get('/contexts/FormalOffer.jsonld').data)['@context']
+    r = client.get(url + '?inlineContext=true')
+    assert r.status_code == 200
+    contents = json.loads(r.data)
+    assert contents['@context'] == context
+    assert contents['@id'] == json.loads(client.get(url).data)['@id']
+    assert r.headers['ETag'] == f'"{offer.document_etag}-inline"'
+
+
+def test_get_proof_inline_context(client, offer, proof):
+    proof_secret = urlsafe_b64encode(proof.proof_secret).decode()
+    r = client.get(f'/payment-proofs/{proof.payee_creditor_id}/{proof.proof_id}/{proof_secret}?inlineContext=true')
+    assert json.loads(r.data)['@context']['paidAt'] == {'@type': 'xsd:dateTime'}
+
+
+def test_list_offers(client, offer):
+    other_offer = procedures.create_formal_offer(
+        offer.payee_creditor_id, 2, [3], [1000], datetime(2098, 1, 1, tzinfo=timezone.utc), None)
+    url = f'/formal-offers/{offer.payee_creditor_id}/'
+    headers = {'X-Swpt-Creditor-Id': str(offer.payee_creditor_id)}
+    assert client.get(url).status_code == 401
+    assert client.get(url, headers={'X-Swpt-Creditor-Id': '666'}).status_code == 403
+    assert client.get(url + '?prev=x', headers=headers).status_code == 400
+    assert client.get(url + '?minValidUntil=x', headers=headers).status_code == 400
+    assert client.get(url + '?maxValidUntil=x', headers=headers).status_code == 400
+
+    r = client.get(url + '?limit=1', headers=headers)
+    assert r.status_code == 200
+    assert r.content_type == 'application/json'
+    page = json.loads(r.data)
+    assert len(page['items']) == 1
+    assert page['items'][0] == json.loads(_get_offer_document(offer))
+    assert page['next'] == f'{url}?limit=1&prev={offer.offer_id}'
+
+    r = client.get(page['next'], headers=headers)
+    page = json.loads(r.data)
+    assert [item['offerId'] for item in page['items']] == [other_offer.offer_id]
+    assert page['next'] == f'{url}?limit=1&prev={other_offer.offer_id}'
+    page = json.loads(client.get(page['next'], headers=headers).data)
+    assert page == {'items': []}
+
+    r = client.get(url + '?maxValidUntil=2098-06-01T00:00:00Z', headers=headers)
+    assert [item['offerId'] for item in json.loads(r.data)['items']] == [other_offer.offer_id]
+
+    r = client.get(url, headers={**headers, 'Accept-Encoding': 'gzip'})
+    assert r.headers['Content-Encoding'] == 'gzip'
+    assert len(json.loads(gzip.decompress(r.data))['items']) == 2
+
+
+def test_list_proofs(client, offer, proof):
+    other_proof = PaymentProof(
+        payee_creditor_id=offer.payee_creditor_id,
+        proof_secret=b'456',
+        payer_creditor_id=3,
+        debtor_id=3,
+        amount=2000,
+        payer_note={},
+        paid_at_ts=datetime(2000, 1, 1, tzinfo=timezone.utc),
+        reciprocal_payment_amount=0,
+        offer_id=offer.offer_id,
+        offer_created_at_ts=offer.created_at_ts,
+    )
+    db.session.add(other_proof)
+    db.session.flush()
+
+    url = f'/payment-proofs/{offer.payee_creditor_id}/'
+    headers = {'X-Swpt-Creditor-Id': str(offer.payee_creditor_id)}
+    assert client.get(url).status_code == 401
+    assert client.get(url + '?prev=1', headers=headers).status_code == 400
+    assert client.get(url + '?prev=1&prevPaidAt=x', headers=headers).status_code == 400
+    assert client.get(url + '?minPaidAt=x', headers=headers).status_code == 400
+    assert client.get(url + '?maxPaidAt=x', headers=headers).status_code == 400
+
+    # The proofs are ordered by the time of the payment.
+    r = client.get(url + '?limit=1', headers=headers)
+    assert r.status_code == 200
+    page = json.loads(r.data)
+    assert [item['paidAmount'] for item in page['items']] == [2000]
+    page = json.loads(client.get(page['next'], headers=headers).data)
+    assert [item['paidAmount'] for item in page['items']] == [1000]
+    assert page['items'][0]['offerDescription'] == procedures.get_description(offer.description_hash)
+    page = json.loads(client.get(page['next'], headers=headers).data)
+    assert page == {'items': []}
+
+    r = client.get(url + '?minPaidAt=2010-01-01', headers=headers)
+    assert [item['paidAmount'] for item in json.loads(r.data)['items']] == [1000]
+
+
+def test_list_payer_proofs(client, offer, proof):
+    url = f'/payer-payment-proofs/{proof.payer_creditor_id}/'
+    assert client.get(url, headers={'X-Swpt-Creditor-Id': str(proof.payee_creditor_id)}).status_code == 403
+    r = client.get(url, headers={'X-Swpt-Creditor-Id': str(proof.payer_creditor_id)})
+    assert r.status_code == 200
+    page = json.loads(r.data)
+    assert len(page['items']) == 1
+    assert page['items'][0]['@id'].endswith(f'/{proof.proof_id}/{urlsafe_b64encode(proof.proof_secret).decode()}')
+    assert 'next' not in page
+
+
+@pytest.mark.slow
+def test_compression_benchmark(client, big_offer):
+    url = _get_offer_url(big_offer)
+    n = 200
+    print()
+    for accept_encoding in ['identity', 'gzip', 'br']:
+        client.get(url, headers={'Accept-Encoding': accept_encoding})
+        started_at = time.process_time()
+        for _ in range(n):
+            r = client.get(url, headers={'Accept-Encoding': accept_encoding})
+        cpu = (time.process_time() - started_at) / n
+        print(f'{accept_encoding}: {len(r.data)} bytes, {cpu * 1e6:.0f}us CPU per request')
+
+    started_at = time.process_time()
+    for _ in range(n):
+        gzip.compress(_get_offer_document(big_offer))
+    print(f'compressing on every request would add {(time.process_time() - started_at) / n * 1e6:.0f}us CPU')
@@ -0,0 +1,50 @@
+from swpt_payments.sizing import calc_sizing, get_cpu_count
+
+
+def test_get_cpu_count():
+    assert get_cpu_count() >= 1
+
+
+def test_calc_sizing():
+    assert calc_sizing({}, 4) == {
+        'DRAMATIQ_PROCESSES': 4,
+        'DRAMATIQ_THREADS': 8,
+        'dramatiq_queue_prefetch': 16,
+        'SQLALCHEMY_POOL_SIZE': 8,
+        'SQLALCHEMY_MAX_OVERFLOW': 17,
+    }
+    assert calc_sizing({'APP_MAX_DB_CONNECTIONS': '10'}, 4) == {
+        'DRAMATIQ_PROCESSES': 4,
+        'DRAMATIQ_THREADS': 2,
+        'dramatiq_queue_prefetch': 4,
+        'SQLALCHEMY_POOL_SIZE': 2,
+        'SQLALCHEMY_MAX_OVERFLOW': 0,
+    }
+    assert calc_sizing({'APP_MAX_DB_CONNECTIONS': '2'}, 4)['DRAMATIQ_PROCESSES'] == 2
+
+
+def test_calc_sizing_explicit_settings():
+    environ = {
+        'DRAMATIQ_PROCESSES': '1',
+        'DRAMATIQ_THREADS': '3',
+        'dramatiq_queue_prefetch': '100',
+        'SQLALCHEMY_POOL_SIZE': 'None',
+        'SQLALCHEMY_MAX_OVERFLOW': '0',
+    }
+    assert calc_sizing(environ, 4) == {
+        'DRAMATIQ_PROCESSES': 1,
+        'DRAMATIQ_THREADS': 3,
+        'dramatiq_queue_prefetch': 100,
+        'SQLALCHEMY_POOL_SIZE': 3,
+        'SQLALCHEMY_MAX_OVERFLOW': 0,
+    }
+
+
+def test_calc_sizing_gevent():
+    assert calc_sizing({'APP_MAX_DB_CONNECTIONS': '100'}, 2, gevent=True) == {
+        'DRAMATIQ_PROCESSES': 2,
+        'DRAMATIQ_GREENLETS': 50,
+        'dramatiq_queue_prefetch': 100,
+        'SQLALCHEMY_POOL_SIZE': 50,
+        'SQLALCHEMY_MAX_OVERFLOW': 0,
+    }